@@ -12,6 +12,8 @@ import argparse
 import getpass
 from lxml import etree
 
+import oc_limiter
+
 
 # Address of the series get endpoint
 SERIES_GET_ENDPOINT = 'series/series.json'
@@ -167,21 +169,23 @@ def main(args):
                     print(u"Aborting on user request")
                     return 0
                 
-            series_deleted = []
-            juapa = True
-            for series in series_to_delete:
-                series_id = series['identifier'][0]['value']
-                r = requests.delete(series_delete_url.format(series_id), auth=auth)
-                
-                series_deleted.append((series,r))
-
+            def print_progress(n_deleted):
                 print(
                     u"\rDeleted ({0}/{1})...".format(
-                        len(series_deleted), len(series_to_delete)),
+                        n_deleted, len(series_to_delete)),
                     end="")
                 sys.stdout.flush()
 
+            # Send the delete requests concurrently, as fast as the server can take them
+            limiter = oc_limiter.from_args(args)
+            series_deleted = zip(series_to_delete, oc_limiter.map_limited(
+                limiter,
+                lambda series: requests.delete(
+                    series_delete_url.format(series['identifier'][0]['value']), auth=auth),
+                series_to_delete, print_progress))
+
             print(u" Finished!\n")
+            print(limiter.summary(), end="\n\n")
 
             for series, r in series_deleted:
                 if r.status_code == 204:
@@ -210,6 +214,7 @@ if __name__ == '__main__':
     parser.add_argument('archive_url', nargs='?', help='The URL of the server running the archive service. Defaults to the series URL parameter.')
     parser.add_argument('-n', '--not_really', action="store_true", help='Do not delete anything, but show what would be done if this option were not provided')
     parser.add_argument('-f', '--force', action="store_true", help='Do not ask for confirmation to delete the workflows. In combination with \'-n\', do not ask for confirmation to print the workflow IDs')
+    oc_limiter.add_arguments(parser)
     parser.add_argument('-u', '--digest_user', help='User to authenticate with the Opencast endpoint in the server')
     parser.add_argument('-p', '--digest_pass', help='Password to authenticate with the Opencast endpoint in the server')
     
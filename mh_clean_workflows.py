@@ -12,6 +12,8 @@ import argparse
 import getpass
 from lxml import etree
 
+import oc_limiter
+
 
 # Allowed Workflow states
 # "Failing" and "running" are not included because they are transient states
@@ -171,17 +173,19 @@ def main(args):
                         print("Aborting on user request")
                         return 0
 
-                wf_deleted = []
-                for mp_id, data in wf_to_delete.iteritems():
-                    for wf_id, state in data['workflows']:
-                        r = requests.delete(wf_delete_url.format(wf_id),
-                                            auth=auth)
-                        wf_deleted.append((wf_id,r))
-
-                    print("\rDeleting ({0}/{1})...".format(len(wf_deleted), wf_processed), end="")
+                def print_progress(n_deleted):
+                    print("\rDeleting ({0}/{1})...".format(n_deleted, wf_processed), end="")
                     sys.stdout.flush()
 
+                # Send the delete requests concurrently, as fast as the server can take them
+                limiter = oc_limiter.from_args(args)
+                wf_ids = [wf_id for data in wf_to_delete.itervalues() for wf_id, state in data['workflows']]
+                wf_deleted = zip(wf_ids, oc_limiter.map_limited(
+                    limiter, lambda wf_id: requests.delete(wf_delete_url.format(wf_id), auth=auth),
+                    wf_ids, print_progress))
+
                 print(" Finished!\n")
+                print(limiter.summary(), end="\n\n")
 
                 for wf_id, r in wf_deleted:
                     if r.status_code == 204:
@@ -219,6 +223,7 @@ if __name__ == '__main__':
     parser.add_argument('states', nargs='+', type=lower_str, choices=WF_VALID_STATES, help='A list of space-separated workflow states that shall be deleted')
     parser.add_argument('-n', '--not_really', action="store_true", help='Do not delete anything, but show what would be done if this option were not provided')
     parser.add_argument('-f', '--force', action="store_true", help='Do not ask for confirmation to delete the workflows. In combination with \'-n\', do not ask for confirmation to print the workflow IDs')
+    oc_limiter.add_arguments(parser)
     parser.add_argument('-u', '--digest_user', help='User to authenticate with the Opencast endpoint in the server')
     parser.add_argument('-p', '--digest_pass', help='Password to authenticate with the Opencast endpoint in the server')
 
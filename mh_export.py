@@ -23,6 +23,21 @@ import getpass
 import signal
 import errno
 import math
+import shutil
+import threading
+import time
+import socket
+import Queue
+import tarfile
+import json
+import datetime
+import multiprocessing
+
+try:
+    import fcntl
+except ImportError:
+    # Reflinks are only attempted where fcntl is available
+    fcntl = None
 
 from StringIO import StringIO
 from lxml import etree
@@ -46,13 +61,134 @@ MP_NAMESPACE="http://mediapackage.opencastproject.org"
 
 # Name of the query parameter to specify the series ID
 QUERY_PARAM_SERIES_ID = "sid"
+# Names of the query parameters to request a page of the search results
+QUERY_PARAM_LIMIT = "limit"
+QUERY_PARAM_OFFSET = "offset"
+
+# Attribute of the search results containing the total number of results
+XML_TOTAL_ATTR = "total"
+
+# Default number of mediapackages requested in every page of the search results
+DEFAULT_PAGE_SIZE = 100
 
 # Boolean value to handle keyboard interruptions gracefully
 INTERRUPTED = True
 
-# Smils to delete
-smils_to_delete = set()
-DELETE_SMILS = True
+# Attribute of the <video> elements in the SMIL files containing the bitrate of each rendition
+XML_SMIL_BITRATE_ATTR = "video-bitrate"
+
+# Modes to choose among the files with the same flavor in a mediapackage
+RENDITIONS_BEST = "best"
+RENDITIONS_LOWEST = "lowest"
+RENDITIONS_ALL = "all"
+
+# Size given to the tasks choosing the files to download in a mediapackage, so that they run before the downloads
+SELECTION_PRIORITY = float("inf")
+
+# Default number of files downloaded in parallel
+DEFAULT_JOBS = 1
+
+# Default number of SSH connections for the downloads and processes the export is split into
+DEFAULT_CONNECTIONS = 1
+DEFAULT_PROCESSES = 1
+
+# Minimum number of seconds between two refreshes of the aggregated progress line
+PROGRESS_INTERVAL = 0.5
+
+# Seconds between two checks of the download pool's state by the main thread
+POOL_POLL_INTERVAL = 0.1
+
+# Size of the chunks read from the remote file listing
+INDEX_BUFFER_SIZE = 65536
+
+# Suffix of the files being downloaded
+PART_SUFFIX = ".part"
+
+# Size of the chunks read when resuming a download
+RESUME_BUFFER_SIZE = 32768
+
+# Size of the first chunks read from the SCP channels. The size doubles while the channel fills the chunks completely,
+# up to the maximum buffer size
+SCP_BUFFER_SIZE = 16384
+DEFAULT_MAX_BUFFER_SIZE = 2 ** 20
+
+# SSH window and maximum packet sizes of the download channels. A window larger than paramiko's default keeps the
+# server sending on links with a high bandwidth-delay product
+SSH_WINDOW_SIZE = 2 ** 24
+SSH_MAX_PACKET_SIZE = 2 ** 16
+
+# Minimum number of seconds between two progress notifications of an SCP client
+SCP_PROGRESS_INTERVAL = 0.1
+
+# Size of the chunks read from the tar streams
+TAR_BUFFER_SIZE = 2 ** 20
+
+# Number of bytes read from each of the largest files to measure the throughput when making a plan
+THROUGHPUT_SAMPLE_SIZE = 2 ** 26
+
+# Keys of the entries in the export plans
+PLAN_MP = "mediapackage"
+PLAN_FLAVOR = "flavor"
+PLAN_PATH = "path"
+PLAN_DIR = "download_dir"
+PLAN_ROOT = "root"
+PLAN_SIZE = "size"
+
+# Seconds of transfer at the maximum rate that may be received at once, after a pause
+RATE_BURST_SECONDS = 0.5
+
+# Name of the manifest of the downloaded files, in the download directory
+MANIFEST_FILE = "manifest.jsonl"
+# Keys of the records in the manifest
+MANIFEST_LOCAL_PATH = "local_path"
+MANIFEST_MP = "mediapackage"
+MANIFEST_ELEMENT = "element"
+MANIFEST_PATH = "path"
+MANIFEST_SIZE = "size"
+MANIFEST_MTIME = "mtime"
+
+# Methods by which the files are obtained, and outcomes of their downloads, in the telemetry
+METHOD_SCP = "scp"
+METHOD_RESUME = "resume"
+METHOD_SEGMENTED = "segmented"
+METHOD_TAR = "tar"
+METHOD_LOCAL = "local"
+METHOD_LINK = "link"
+STATUS_OK = "ok"
+STATUS_MISSING = "missing"
+STATUS_SKIPPED = "skipped"
+STATUS_FAILED = "failed"
+# Names of the tasks not related to a single file whose time is measured in the telemetry
+TIMING_INDEX = "indexing"
+TIMING_SEARCH = "searching"
+TIMING_SELECTION = "selecting renditions"
+
+# Default number of times a download is tried again after a connection error, and seconds to wait before the
+# first retry. The wait grows linearly with the retries
+DEFAULT_RETRIES = 2
+RETRY_DELAY = 1
+
+# Multipliers of the suffixes accepted in the sizes and transfer rates
+BYTE_SUFFIXES = { "k": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30 }
+
+# Files at least this large are downloaded in several segments at once, if enabled
+DEFAULT_SEGMENT_THRESHOLD = 2 ** 30
+# Default number of segments of those files. The segmented downloads need SFTP, so they are disabled by default
+DEFAULT_SEGMENTS = 1
+# Suffix of the file where the state of a segmented download is kept, next to the partial file
+SEGMENTS_SUFFIX = ".segments"
+# Size of the requests of each segment read in advance
+SEGMENT_WINDOW_SIZE = 2 ** 23
+# Size of the chunks read from each segment
+SEGMENT_CHUNK_SIZE = 2 ** 20
+# Minimum number of seconds between two updates of the state of a segmented download
+SEGMENT_STATE_INTERVAL = 1
+
+# Linux ioctl request to clone a file (reflink), in filesystems supporting copy-on-write
+FICLONE = 0x40049409
+
+# Size of the chunks copied when the files are read from a local mountpoint
+LOCAL_COPY_CHUNK_SIZE = 2 ** 23
 
 # Handle keyboard interrupts gracefully
 def sigint_handler(signal, frame):
@@ -210,90 +346,1262 @@ def get_relative_path_from_url(url):
     return get_relative_path(url_parsed.path)
 
 
-def download_path(scp, path, download_dir, dirs):
+class RemoteIndex(object):
+    """
+    Index of the files under the configured directories in the remote server.
+    The whole listing is fetched with a single 'find' command, so that locating each file does not require
+    any further round trips to the server. The index maps each path, relative to the directory where it was
+    found, to a tuple (directory, size, modification time, device, inode)
+    """
+
+    def __init__(self, transport, dirs):
+        self._files = {}
+
+        chan = transport.open_session()
+        # %H is the directory where the search started, %P the path relative to it.
+        # %D and %i (device and inode) identify the physical file, also when it is reached through a symlink.
+        # Entries are NUL-terminated, so that no file name can break the parsing
+        chan.exec_command("find -L {0} -type f -printf '%H\\t%s\\t%T@\\t%D\\t%i\\t%P\\0'".format(
+            " ".join(_sh_quote(asbytes(d)) for d in dirs)))
+
+        pending = b''
+        while True:
+            data = chan.recv(INDEX_BUFFER_SIZE)
+            if not data:
+                break
+            entries = (pending + data).split(b'\0')
+            pending = entries.pop()
+            for entry in entries:
+                self._add(entry)
+
+        status = chan.recv_exit_status()
+        if status != 0:
+            # Nonexistent directories or symlink loops make 'find' fail, but the rest of the listing is still valid
+            print("WARNING: Indexing the remote directories returned error code {0}: {1}".format(
+                status, chan.makefile_stderr().read().strip()), file=sys.stderr)
+        chan.close()
+
+    def _add(self, entry):
+        root, size, mtime, device, inode, path = entry.split(b'\t', 5)
+        path = os.path.normpath(path)
+        # Keep the first occurrence, as a sequential search would do
+        if path not in self._files:
+            self._files[path] = (root, int(size), float(mtime), int(device), int(inode))
+
+    def __len__(self):
+        return len(self._files)
+
+    def lookup(self, path):
+        """
+        Return the tuple (directory, size, modification time, device, inode) of the given relative path, or None if it
+        was not found
+        """
+        return self._files.get(os.path.normpath(path))
+
+    def roots(self, path):
+        """
+        Return a list with the directory containing the given relative path, or an empty list if it was not found
+        """
+        entry = self.lookup(path)
+        return [] if entry is None else [entry[0]]
+
+
+def get_mediapackages(server, endpoint, query_params, user, password, page_size):
+    """
+    Iterate through the mediapackages returned by the search endpoint, requesting them in pages of 'page_size'
+    results. Each page is parsed incrementally and every mediapackage is cleared once the caller is done with it,
+    so that the memory used does not grow with the size of the series
+    """
+    query_params = dict(query_params)
+    offset = 0
+    while True:
+        query_params[QUERY_PARAM_LIMIT] = page_size
+        query_params[QUERY_PARAM_OFFSET] = offset
+
+        page = StringIO()
+        try:
+            curl(server, endpoint, query_params=query_params, user=user, password=password, write_to=page)
+            page.seek(0)
+
+            total = None
+            count = 0
+            for event, element in etree.iterparse(page, events=("start", "end")):
+                if event == "start":
+                    # The root element has the total number of results, if the endpoint provides it
+                    if total is None and element.getparent() is None and element.get(XML_TOTAL_ATTR) is not None:
+                        total = int(element.get(XML_TOTAL_ATTR))
+                elif element.tag == '{{{0}}}mediapackage'.format(MP_NAMESPACE):
+                    count += 1
+                    yield element
+
+                    # Free the mediapackage and whatever was parsed before it
+                    element.clear()
+                    for ancestor in element.iterancestors():
+                        while ancestor.getprevious() is not None:
+                            del ancestor.getparent()[0]
+        finally:
+            page.close()
+
+        offset += count
+        # The service may return fewer results than requested, so rely on the total when it is known
+        if count == 0 or (total is not None and offset >= total) or (total is None and count < page_size):
+            break
+
+
+class Export(object):
+    """
+    Settings and state shared by all the downloads of an export
+    """
+
+    def __init__(self, pool, dirs, index=None, resume=False, links=None, local_roots=(), renditions=None,
+                 tar=False, segments=1, segment_threshold=None, manifest=None, sync=False, telemetry=None, retries=0):
+        # Pool running the downloads
+        self.pool = pool
+        # Remote directories where the files are searched for
+        self.dirs = dirs
+        # RemoteIndex of the files in those directories, if any
+        self.index = index
+        # Whether partial downloads should be resumed
+        self.resume = resume
+        # LinkRegistry of the files already downloaded, if duplicates should be hardlinked
+        self.links = links
+        # Local directories where the files are looked for before downloading them from the server
+        self.local_roots = local_roots
+        # Which of the files with the same flavor are downloaded: one of the RENDITIONS_* modes or a maximum bitrate
+        self.renditions = renditions or RENDITIONS_ALL
+        # Whether the files of each mediapackage are transferred through a single tar stream
+        self.tar = tar
+        # Number of segments downloaded at once of the files of at least segment_threshold bytes
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        # Manifest where the downloaded files are recorded
+        self.manifest = manifest
+        # Whether only the files that are new or changed since they were recorded in the manifest are downloaded
+        self.sync = sync
+        # Telemetry where the metrics of the downloads are recorded
+        self.telemetry = telemetry
+        # Number of times a download is tried again after a connection error
+        self.retries = retries
+        # IDs of the mediapackages whose files could not be chosen, so all their tracks were downloaded
+        self.selection_failures = []
+
+
+# Download a path, relative to one of the configured directories, into the local download directory
+# If an index of the remote files is provided, it is used to find the file's location. Otherwise, every directory
+# in 'dirs' is tried in turn
+# This function runs in the workers of a DownloadPool. The interruptions are handled by the pool and the
+# main thread, so here we simply stop as soon as possible
+def download_path(worker, path, download_dir, export):
 
-    global INTERRUPTED, smils_to_delete
+    global INTERRUPTED
 
     if INTERRUPTED:
-        interrupted()
+        return
 
-    # Check the extension
-    ext = urlpath.splitext(path)[1]
+    entry = export.index.lookup(path) if export.index is not None else None
+    roots = get_roots(export, path)
 
-    if ext == ".smil":
-        # Append the relative path to the local download directory
-        local_path = os.path.join(download_dir, path)
-        smils_to_delete.add(local_path)
-    else:
-        # Remove the two latest directory levels (filename and element ID)
-        reduced_path = path
-        for i in range(2):
-            reduced_path = os.path.dirname(reduced_path)
+    local_path = get_local_path(path, download_dir)
 
-        local_path = os.path.join(download_dir, os.path.relpath(path, reduced_path))
+    # The file is downloaded under a temporary name and only renamed when complete,
+    # so that an existing file is never a partial download
+    part_path = local_path + PART_SUFFIX
 
-    if os.path.exists(local_path):
-        print(u"Skipping the download of already-existing path: {0}".format(local_path))
+    if export.sync and is_synced(export, path, local_path, entry):
         return
 
+    if os.path.exists(local_path) and not export.resume:
+        export.pool.progress.message(u"Skipping the download of already-existing path: {0}".format(local_path))
+        return
+
+    link_key = None
+    if export.links is not None:
+        link_key = claim_link(export, path, entry, local_path, download_dir)
+        if link_key is None:
+            return
+
+    downloaded = False
+    # Metrics of the download: time spent looking for the file, as opposed to transferring it, number of retries,
+    # how the file was obtained and from which directory
+    start = time.time()
+    lookup_time = 0
+    retries = 0
+    method = served_from = None
+    # Bytes actually transferred in this run, which exclude the part of the file downloaded by a previous one.
+    # None if the file was already complete
+    transferred = 0
+    status = STATUS_MISSING
     try:
-        # Attempt to create the local directories
-        os.makedirs(os.path.dirname(local_path), DIRMODE)
-    except OSError as e:
-        if e.errno == errno.EEXIST:
-            if os.path.dirname(local_path) != download_dir:
-                # The directory already exists. Assume this file have already been downloaded
-                print(u"WARN: Tried to create an already-existing directory: '{0}'.\nSkipping download...".format(os.path.dirname(local_path)), file=sys.stderr)
-                return
+        try:
+            # Attempt to create the local directories
+            os.makedirs(os.path.dirname(local_path), DIRMODE)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                if os.path.dirname(local_path) != download_dir and not export.resume:
+                    # The directory already exists. Assume this file have already been downloaded
+                    export.pool.progress.message(u"WARN: Tried to create an already-existing directory: '{0}'.\nSkipping download...".format(os.path.dirname(local_path)), sys.stderr)
+                    status = STATUS_SKIPPED
+                    return
+            else:
+                # Raise the exception in any other case
+                raise
+
+        # Files available in a local mountpoint are copied from there
+        source_path = find_local_path(path, export.local_roots)
+        if source_path is not None:
+            lookup_time = time.time() - start
+            transferred = copy_local_file(source_path, local_path, part_path, export.pool.progress, export.resume)
+            method, served_from = METHOD_LOCAL, source_path[:-len(path)].rstrip(os.sep)
         else:
-            # Raise the exception in any other case
-            raise
+            # Try to find the relative path in one of the directories read in the configuration
+            for root in roots:
+                attempt_start = time.time()
+                method, attempt_retries, transferred = fetch_remote(worker, os.path.join(root, path), entry,
+                                                                    local_path, part_path, export)
+                retries += attempt_retries
+                if INTERRUPTED:
+                    # Partial downloads are left to be resumed
+                    return
+                if method is not None:
+                    # We assume the first correct download is the only one possible, so we break
+                    served_from = root
+                    break
+                # The time spent on the directories without the file is part of the lookup
+                lookup_time += time.time() - attempt_start
+            else:
+                export.pool.progress.message(u"The file '{0}' could not be found in the configured locations".format(path),
+                                             sys.stderr)
+
+        if method is not None:
+            downloaded = True
+            export.manifest.add(local_path, path, entry)
+            export.pool.progress.finish(part_path)
+            if transferred is None:
+                # Already complete. It does not count as a transfer
+                method, transferred = None, 0
+                status = STATUS_SKIPPED
+            else:
+                status = STATUS_OK
+    except Exception:
+        status = STATUS_FAILED
+        raise
+    finally:
+        if link_key is not None:
+            release_link(export, link_key, path, local_path, downloaded)
+        if not INTERRUPTED:
+            wall_time = time.time() - start
+            export.telemetry.record(path, served_from, method, transferred if downloaded else 0, lookup_time,
+                                    wall_time - lookup_time if status != STATUS_SKIPPED else 0, retries, status)
+
 
-    # Try to find the relative path in one of the directories read in the configuration
-    for root in dirs:
+def fetch_remote(worker, remote_path, entry, local_path, part_path, export):
+    """
+    Download a file from one of the remote directories, trying again up to export.retries times after a connection
+    error. Return the method used, the number of retries and the bytes transferred (None if the local file was already
+    complete), or None as the method if the file is not in that directory
+    """
+    retries = 0
+    while True:
         try:
-            # Try to fetch the remote the remote file
-            scp.get(os.path.join(root, path),
-                    local_path,
-                    recursive=True)
+            if is_segmented(entry, export) and worker.sftp_available():
+                transferred = download_segmented(worker, remote_path, entry[1], local_path, part_path, export)
+                return METHOD_SEGMENTED, retries, transferred
+            elif export.resume:
+                transferred = resume_path(worker, remote_path, entry[1] if entry else None,
+                                          local_path, part_path, export.pool.progress)
+                return METHOD_RESUME, retries, transferred
+            else:
+                # Try to fetch the remote the remote file
+                worker.scp.get(remote_path,
+                               part_path,
+                               recursive=True)
+                os.rename(part_path, local_path)
+                return METHOD_SCP, retries, os.path.getsize(local_path)
+        except SCPException:
+            # No problem. The file may not exist in that directory. Ignore.
+            return None, retries, 0
+        except (paramiko.SSHException, socket.error) as e:
+            if retries >= export.retries or INTERRUPTED:
+                raise
+            retries += 1
+            export.pool.progress.message(u"WARNING: Retrying the download of '{0}' after an error ({1}): {2}"
+                                         .format(remote_path, type(e).__name__, e))
+            time.sleep(RETRY_DELAY * retries)
+
+
+def claim_link(export, path, entry, local_path, download_dir):
+    """
+    Claim the download of a file in the export's LinkRegistry.
+    Return the key to release once the download finishes, or None if the file does not need to be downloaded
+    because it is a duplicate. In that case, it is linked to the other copy, now or once it is complete
+    """
+    link_key = get_link_key(path, entry)
+    copy_path = export.links.claim(link_key, path, local_path, download_dir)
+    if copy_path is None:
+        return link_key
+
+    # Another download is taking care of this file
+    if copy_path:
+        link_file(copy_path, local_path)
+        export.manifest.add(local_path, path, entry)
+        export.telemetry.record(path, None, METHOD_LINK, 0, 0, 0, 0, STATUS_OK)
+        export.pool.progress.message(u"Linked duplicate file {0} to {1}".format(local_path, copy_path))
+    return None
+
+
+def get_link_key(path, entry):
+    """
+    Return the key identifying a remote file in the LinkRegistry: its device and inode if the file is indexed.
+    Without an index, only the relative path identifies the file
+    """
+    return entry[3:] if entry is not None else path
+
+
+def release_link(export, link_key, path, local_path, downloaded):
+    """
+    Release a key claimed with claim_link and link the duplicates waiting for the download to finish
+    """
+    waiting = export.links.release(link_key, downloaded)
+    if downloaded:
+        for waiting_path, waiting_local_path, waiting_dir in waiting:
+            link_file(local_path, waiting_local_path)
+            export.manifest.add(waiting_local_path, waiting_path,
+                                export.index.lookup(waiting_path) if export.index is not None else None)
+            export.telemetry.record(waiting_path, None, METHOD_LINK, 0, 0, 0, 0, STATUS_OK)
+            export.pool.progress.message(u"Linked duplicate file {0} to {1}".format(waiting_local_path, local_path))
+    else:
+        # This copy could not be downloaded. Let the other occurrences try on their own
+        for waiting_path, waiting_local_path, waiting_dir in waiting:
+            export.pool.submit(download_path, waiting_path, waiting_dir, export)
+
+
+def get_local_path(path, download_dir):
+    """
+    Return the local path where the file with the given relative path is downloaded
+    """
+    # Remove the two latest directory levels (filename and element ID)
+    reduced_path = path
+    for i in range(2):
+        reduced_path = os.path.dirname(reduced_path)
+
+    return os.path.join(download_dir, os.path.relpath(path, reduced_path))
+
+
+def read_remote_file(transport, remote_path):
+    """
+    Read a whole remote file in memory with 'cat', for the servers that do not allow SFTP.
+    Raise IOError with errno ENOENT if the file does not exist
+    """
+    channel = transport.open_session(window_size=SSH_WINDOW_SIZE, max_packet_size=SSH_MAX_PACKET_SIZE)
+    try:
+        channel.exec_command("cat {0}".format(_sh_quote(remote_path)))
+        data = b"".join(iter(lambda: channel.recv(TAR_BUFFER_SIZE), b""))
+        status = channel.recv_exit_status()
+        if status != 0:
+            error = channel.makefile_stderr("rb").read().strip()
+            raise IOError(errno.ENOENT if b"No such file" in error else errno.EIO,
+                          u"Could not read '{0}': {1}".format(remote_path, error.decode("utf-8", "replace")))
+        return data
+    finally:
+        channel.close()
+
+
+def get_smil_renditions(read_file, path, roots, local_roots=()):
+    """
+    Read a SMIL file in memory, from a local mountpoint or else from the first of the remote directories containing it.
+    'read_file' is a function returning the contents of a remote file, such as Worker.read_file.
+    Return a list with the relative path and bitrate (None if unknown) of each rendition in it, or None if the file
+    could not be found
+    """
+    source_path = find_local_path(path, local_roots)
+    if source_path is not None:
+        with open(source_path, "rb") as f:
+            data = f.read()
+    else:
+        for root in roots:
+            try:
+                data = read_file(os.path.join(root, path))
+                break
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        else:
+            return None
+
+    renditions = []
+    for xml_element in etree.fromstring(data).iter("video"):
+        bitrate = xml_element.get(XML_SMIL_BITRATE_ATTR)
+        renditions.append((get_relative_path(xml_element.get("src")),
+                           int(bitrate) if bitrate and bitrate.isdigit() else None))
+    return renditions
+
+
+def get_roots(export, path):
+    """
+    Return the remote directories where a relative path may be
+    """
+    if export.index is not None:
+        # The index tells us directly in which directory, if any, the file is
+        entry = export.index.lookup(path)
+        return [entry[0]] if entry is not None else []
+    return export.dirs
+
+
+def select_tracks(read_file, tracks, export):
+    """
+    Replace the SMIL files among the tracks of a mediapackage by the renditions they contain, and choose among the
+    files with the same flavor, which carry the same content, according to the export's renditions mode.
+    The tracks are (path, flavor, bitrate) tuples. Return a list of (path, flavor) tuples.
+    Files with an unknown bitrate cannot be compared, so they are always kept
+    """
+    candidates = []
+    for path, flavor, bitrate in tracks:
+        if urlpath.splitext(path)[1] == ".smil":
+            renditions = get_smil_renditions(read_file, path, get_roots(export, path), export.local_roots)
+            if renditions is None:
+                export.pool.progress.message(u"The file '{0}' could not be found in the configured locations".format(path),
+                                             sys.stderr)
+                continue
+            candidates.extend((rendition, flavor, rendition_bitrate) for rendition, rendition_bitrate in renditions)
+        else:
+            candidates.append((path, flavor, bitrate))
+
+    if export.renditions == RENDITIONS_ALL:
+        return [ (path, flavor) for path, flavor, bitrate in candidates ]
+
+    chosen = {}
+    for path, flavor, bitrate in candidates:
+        if bitrate is None:
+            continue
+        current = chosen.get(flavor)
+        if current is None:
+            chosen[flavor] = (path, bitrate)
+        elif export.renditions == RENDITIONS_LOWEST:
+            if bitrate < current[1]:
+                chosen[flavor] = (path, bitrate)
+        elif export.renditions == RENDITIONS_BEST:
+            if bitrate > current[1]:
+                chosen[flavor] = (path, bitrate)
+        # Otherwise, the mode is a maximum bitrate: the best one not exceeding it, or else the lowest one
+        elif (current[1] > export.renditions and bitrate < current[1]) or (current[1] < bitrate <= export.renditions):
+            chosen[flavor] = (path, bitrate)
+
+    return [ (path, flavor) for path, flavor, bitrate in candidates
+             if bitrate is None or chosen[flavor][0] == path ]
+
+
+def select_or_keep_tracks(read_file, mp_id, tracks, export):
+    """
+    Choose the files to download among the tracks of a mediapackage, as select_tracks does. If that fails, e.g.
+    because a SMIL file cannot be read, keep all the tracks as they are, SMIL files included, rather than losing
+    the whole mediapackage. The failure is recorded in the export, so that it ends with an error status
+    """
+    try:
+        return select_tracks(read_file, tracks, export)
+    except Exception as e:
+        export.selection_failures.append(mp_id)
+        export.pool.progress.message(u"ERROR ({0}) while choosing the files of the mediapackage '{1}': {2}\n"
+                                     u"Downloading all its tracks instead".format(type(e).__name__, mp_id, e), sys.stderr)
+        return [ (path, flavor) for path, flavor, bitrate in tracks ]
 
-            # File correctly downloaded
-            print("Done!")
 
-            if INTERRUPTED:
-                interrupted()
+def download_mediapackage(worker, mp_id, tracks, download_dir, export):
+    """
+    Choose the files to download among the tracks of a mediapackage and the renditions in its SMIL files, and queue
+    their downloads. In tar mode, they are fetched through one stream
+    """
+    if INTERRUPTED:
+        return
 
-            # If this is a SMIL file, try and download its contents
-            if ext is not None and ext == ".smil":
-                print(u"This was a SMIL file. We proceed to download the files inside it.")
-                with open(local_path, "r+") as f:
-                    smil = etree.parse(f)
+    start = time.time()
+    paths = [ path for path, flavor in select_or_keep_tracks(worker.read_file, mp_id, tracks, export) ]
+    export.telemetry.add_time(TIMING_SELECTION, time.time() - start)
+    if export.tar:
+        export.pool.submit(download_tar, paths, download_dir, export,
+                           size=sum(get_size(export.index, path) for path in paths))
+    else:
+        for path in paths:
+            export.pool.submit(download_path, path, download_dir, export, size=get_size(export.index, path))
 
-                for xml_element in smil.iter("video"):
-                    download_path(scp, get_relative_path(xml_element.get("src")), download_dir, dirs)
 
-                print(u"Finished downloading media files in the SMIL file '{0}'".format(path))
+def download_tar(worker, paths, download_dir, export):
+    """
+    Download several files at once through a single tar stream, so that the files in a mediapackage do not cost one
+    SCP round trip each. The stream is unpacked on the fly into the same local layout as download_path.
+    Only the files in the remote index can be requested this way; the rest go through download_path
+    """
+    if INTERRUPTED:
+        return
 
-            # We assume the first correct download is the only one possible, so we break
+    # Local path of each member of the stream, by remote directory
+    members = {}
+    for path in paths:
+        entry = export.index.lookup(path) if export.index is not None else None
+        local_path = get_local_path(path, download_dir)
+
+        if export.sync and is_synced(export, path, local_path, entry):
+            continue
+
+        if os.path.exists(local_path):
+            if not export.resume:
+                export.pool.progress.message(u"Skipping the download of already-existing path: {0}".format(local_path))
+                continue
+            if entry is not None and os.path.getsize(local_path) == entry[1]:
+                export.pool.progress.message(u"Skipping the download of already-complete path: {0}".format(local_path))
+                continue
+
+        if entry is None or find_local_path(path, export.local_roots) is not None or is_segmented(entry, export):
+            # These files need the individual treatment of download_path
+            export.pool.submit(download_path, path, download_dir, export)
+            continue
+
+        link_key = None
+        if export.links is not None:
+            link_key = claim_link(export, path, entry, local_path, download_dir)
+            if link_key is None:
+                continue
+
+        members.setdefault(entry[0], {})[os.path.normpath(path)] = (local_path, link_key, entry)
+
+    if not members:
+        return
+
+    command = ["tar", "cf", "-"]
+    for root, root_members in members.iteritems():
+        command.extend(["-C", root])
+        command.extend(root_members)
+
+    received = set()
+    try:
+        # The time until the first member arrives counts as the lookup of the first file
+        start = time.time()
+        channel = worker.transport.open_session(window_size=SSH_WINDOW_SIZE, max_packet_size=SSH_MAX_PACKET_SIZE)
+        try:
+            channel.exec_command(" ".join(_sh_quote(arg) for arg in command))
+            stream = tarfile.open(fileobj=channel.makefile("rb"), mode="r|", bufsize=TAR_BUFFER_SIZE)
+            for member in stream:
+                if INTERRUPTED:
+                    return
+
+                name = os.path.normpath(member.name)
+                for root, root_members in members.iteritems():
+                    if name in root_members:
+                        local_path, link_key, entry = root_members[name]
+                        break
+                else:
+                    # Not one of the requested files
+                    continue
+
+                if not member.isfile():
+                    continue
+
+                try:
+                    os.makedirs(os.path.dirname(local_path), DIRMODE)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+
+                part_path = local_path + PART_SUFFIX
+                transfer_start = time.time()
+                source = stream.extractfile(member)
+                with open(part_path, "wb") as f:
+                    written = 0
+                    export.pool.progress(part_path, member.size, written)
+                    for chunk in iter(lambda: source.read(TAR_BUFFER_SIZE), b""):
+                        if worker.limiter is not None:
+                            worker.limiter.consume(len(chunk))
+                        f.write(chunk)
+                        written += len(chunk)
+                        export.pool.progress(part_path, member.size, written)
+                os.chmod(part_path, member.mode)
+                os.rename(part_path, local_path)
+                export.manifest.add(local_path, name, entry)
+                export.pool.progress.finish(part_path)
+                now = time.time()
+                export.telemetry.record(name, root, METHOD_TAR, member.size, transfer_start - start,
+                                        now - transfer_start, 0, STATUS_OK)
+                start = now
+
+                received.add(name)
+
+            # Drain the stream, so that the remote tar exits
+            while channel.recv(TAR_BUFFER_SIZE):
+                pass
+            status = channel.recv_exit_status()
+            if status != 0:
+                error = b""
+                while channel.recv_stderr_ready():
+                    error += channel.recv_stderr(TAR_BUFFER_SIZE)
+                export.pool.progress.message(u"WARNING: The remote tar exited with code {0}: {1}".format(
+                    status, error.strip().decode("utf-8", "replace")))
+        finally:
+            channel.close()
+    finally:
+        for root_members in members.itervalues():
+            for name, (local_path, link_key, entry) in root_members.iteritems():
+                if link_key is not None:
+                    release_link(export, link_key, name, local_path, name in received)
+                if name not in received and not INTERRUPTED:
+                    # Whatever the stream did not contain is tried again individually
+                    export.pool.submit(download_path, name, download_dir, export)
+
+
+def get_series_tracks(search_url, args, series_id, series_dir, mp_dirs, known_dirs={}, telemetry=None):
+    """
+    Iterate through the mediapackages of a series, returning the directory assigned to each of them and the
+    relative paths, flavors and video bitrates (None if unknown) of its matching tracks.
+    The mediapackages in 'known_dirs' keep the directory they were downloaded to before.
+    The time spent on the search is added to the telemetry, if given
+    """
+    mp = None
+    search_start = time.time()
+    for mp in get_mediapackages(search_url, args.endpoint, { QUERY_PARAM_SERIES_ID: series_id },
+                                args.digest_user, args.digest_pass, args.page_size):
+        if telemetry is not None:
+            telemetry.add_time(TIMING_SEARCH, time.time() - search_start)
+        if INTERRUPTED:
             break
-        except SCPException:
-            # No problem. The file may not exist in that directory. Ignore.
-            pass
+        mp_title = mp.find('{{{0}}}title'.format(MP_NAMESPACE)).text.replace("/", "_")
+        if mp.get("id") in known_dirs:
+            mp_dir = known_dirs[mp.get("id")]
+        else:
+            mp_dir = get_unique_path(os.path.join(series_dir, mp_title), mp_dirs,
+                                     args.sync or (not args.resume and not args.plan))
+
+        matching_tracks = [ track for track in mp.iter('{{{0}}}track'.format(MP_NAMESPACE))
+                            if (not args.flavors or track.get("type") in args.flavors) and
+                            (not args.tags or args.tags.intersection([ tag.text for tag in track.iterfind('.//{{{0}}}tag'.format(MP_NAMESPACE))]))]
+
+        if matching_tracks:
+            # Get the relative paths of the tracks' URLs in the remote server
+            yield mp.get("id"), mp_dir, [ (get_relative_path_from_url(track.find('{{{0}}}url'.format(MP_NAMESPACE)).text),
+                                           track.get("type"),
+                                           get_track_bitrate(track))
+                                          for track in matching_tracks ]
+        else:
+            print(u"No matching tracks found in mediapackage '{0}': {1}\n".format(mp.get("id"), mp_title), file=sys.stderr)
+
+        search_start = time.time()
+
+    if mp is None:
+        print(u"The search returned no mediapackages for the series '{0}".format(series_id))
+
+
+def get_track_bitrate(track):
+    """
+    Return the video bitrate of a track in a mediapackage, or None if it is unknown
+    """
+    bitrate = track.findtext('{{{0}}}video/{{{0}}}bitrate'.format(MP_NAMESPACE))
+    try:
+        return int(float(bitrate))
+    except (TypeError, ValueError):
+        return None
+
+
+def plan_tracks(read_file, export, mp_id, tracks, download_dir):
+    """
+    Resolve the tracks of a mediapackage through the remote index, after replacing the SMIL files by their
+    renditions and choosing among them as the export would.
+    Return a list of plan entries, one per file to download. The files that are not found have no root nor size
+    """
+    entries = []
+    for path, flavor in select_or_keep_tracks(read_file, mp_id, tracks, export):
+        entry = export.index.lookup(path) if export.index is not None else None
+        entries.append({ PLAN_MP: mp_id,
+                         PLAN_FLAVOR: flavor,
+                         PLAN_PATH: path,
+                         PLAN_DIR: download_dir,
+                         PLAN_ROOT: entry[0] if entry is not None else None,
+                         PLAN_SIZE: entry[1] if entry is not None else None })
+    return entries
+
+
+def measure_throughput(transport, plan, jobs):
+    """
+    Measure the transfer rate, in bytes per second, of reading the beginning of the largest files in the plan with
+    as many parallel channels as workers
+    """
+    samples = sorted((entry for entry in plan if entry[PLAN_SIZE]), key=lambda entry: entry[PLAN_SIZE], reverse=True)[:jobs]
+    received = []
+
+    def read_sample(entry):
+        channel = transport.open_session(window_size=SSH_WINDOW_SIZE, max_packet_size=SSH_MAX_PACKET_SIZE)
+        try:
+            channel.exec_command("head -c {0} {1}".format(THROUGHPUT_SAMPLE_SIZE,
+                                                          _sh_quote(os.path.join(entry[PLAN_ROOT], entry[PLAN_PATH]))))
+            total = 0
+            for chunk in iter(lambda: channel.recv(TAR_BUFFER_SIZE), b""):
+                total += len(chunk)
+            received.append(total)
+        finally:
+            channel.close()
+
+    threads = [ threading.Thread(target=read_sample, args=(entry,)) for entry in samples ]
+    start = time.time()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(POOL_POLL_INTERVAL)
+    elapsed = time.time() - start
+
+    if not sum(received) or not elapsed:
+        return None
+    return sum(received) / elapsed
+
+
+def print_plan(plan, throughput, jobs, export):
+    """
+    Print a summary of the plan: number of files, bytes and estimated duration, in total and by flavor.
+    If the export links the duplicate files, the bytes of each remote file are only counted once
+    """
+    flavors = {}
+    missing = 0
+    seen = set()
+    duplicates = duplicate_size = 0
+    for entry in plan:
+        if entry[PLAN_SIZE] is None:
+            missing += 1
+            continue
+        size = entry[PLAN_SIZE]
+        if export.links is not None:
+            link_key = get_link_key(entry[PLAN_PATH], export.index.lookup(entry[PLAN_PATH]))
+            if link_key in seen:
+                duplicates += 1
+                duplicate_size += size
+                size = 0
+            else:
+                seen.add(link_key)
+        files, flavor_size = flavors.get(entry[PLAN_FLAVOR], (0, 0))
+        flavors[entry[PLAN_FLAVOR]] = (files + 1, flavor_size + size)
+
+    total_files = sum(files for files, size in flavors.itervalues())
+    total_size = sum(size for files, size in flavors.itervalues())
+
+    print(u"{0:<40} {1:>8} {2:>14}".format(u"Flavor", u"Files", u"Size"))
+    for flavor, (files, size) in sorted(flavors.iteritems()):
+        print(u"{0:<40} {1:>8} {2:>14}".format(flavor, files, convert_si(size)))
+    print(u"{0:<40} {1:>8} {2:>14}".format(u"Total", total_files, convert_si(total_size)))
+
+    if duplicates:
+        print(u"\n{0} files ({1}) are duplicates of other files, so they are linked instead of downloaded"
+              .format(duplicates, convert_si(duplicate_size)))
+    if missing:
+        print(u"\n{0} files could not be found in the configured locations".format(missing))
+
+    if throughput:
+        print(u"\nMeasured throughput with {0} parallel transfer(s): {1}/s".format(jobs, convert_si(int(throughput))))
+        print(u"Estimated duration: {0}".format(datetime.timedelta(seconds=int(total_size / throughput))))
+
+
+def save_plan(plan, plan_file, download_dir):
+    """
+    Save the plan as JSON. The download directories are stored relative to the export's directory
+    """
+    with open(plan_file, "w") as f:
+        json.dump([ dict(entry, **{ PLAN_DIR: os.path.relpath(entry[PLAN_DIR], download_dir) }) for entry in plan ],
+                  f, indent=1)
+
+
+def load_plan(plan_file, download_dir):
+    """
+    Load a plan saved by save_plan, for an export into the given directory
+    """
+    with open(plan_file) as f:
+        return [ dict(entry, **{ PLAN_DIR: os.path.normpath(os.path.join(download_dir, entry[PLAN_DIR])) })
+                 for entry in json.load(f) ]
+
+
+def submit_plan(pool, plan, export, tar):
+    """
+    Queue the downloads in a plan. The pool runs the largest ones first
+    """
+    if tar:
+        mediapackages = {}
+        for entry in plan:
+            mediapackages.setdefault(entry[PLAN_DIR], []).append(entry)
+        for download_dir, entries in mediapackages.iteritems():
+            pool.submit(download_tar, [ entry[PLAN_PATH] for entry in entries ], download_dir, export,
+                        size=sum(entry[PLAN_SIZE] or 0 for entry in entries))
     else:
-        print(u"The file '{0}' could not be found in the configured locations".format(path), file=sys.stderr)
+        for entry in plan:
+            pool.submit(download_path, entry[PLAN_PATH], entry[PLAN_DIR], export, size=entry[PLAN_SIZE] or 0)
+
+
+class Manifest(object):
+    """
+    Record of the files downloaded into an export directory, with the mediapackage and element IDs, relative remote
+    path, size and modification time of each of them.
+    Every file is appended as a JSON line as soon as it is complete, so that the record survives interruptions and
+    can be written by several processes. When a file is recorded again, the last line prevails
+    """
+
+    def __init__(self, download_dir):
+        self.download_dir = download_dir
+        self.path = os.path.join(download_dir, MANIFEST_FILE)
+        self._lock = threading.Lock()
+        # Local path, relative to the download directory -> record
+        self.records = {}
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line left incomplete by an interruption
+                        continue
+                    self.records[record[MANIFEST_LOCAL_PATH]] = record
+
+    def add(self, local_path, path, entry):
+        """
+        Record a complete file, given its local path, its relative remote path and its entry in the remote index
+        """
+        # The remote paths end in <mediapackage ID>/<element ID>/<file name>
+        parts = urlpath.normpath(path).split("/")
+        record = { MANIFEST_LOCAL_PATH: os.path.relpath(local_path, self.download_dir),
+                   MANIFEST_MP: parts[-3] if len(parts) >= 3 else None,
+                   MANIFEST_ELEMENT: parts[-2] if len(parts) >= 2 else None,
+                   MANIFEST_PATH: path,
+                   MANIFEST_SIZE: entry[1] if entry is not None else os.path.getsize(local_path),
+                   MANIFEST_MTIME: entry[2] if entry is not None else None }
+
+        with self._lock:
+            self.records[record[MANIFEST_LOCAL_PATH]] = record
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def lookup(self, local_path):
+        return self.records.get(os.path.relpath(local_path, self.download_dir))
+
+    def mediapackage_dirs(self):
+        """
+        Return the directory where each of the recorded mediapackages was downloaded
+        """
+        return dict((record[MANIFEST_MP], os.path.dirname(os.path.dirname(os.path.join(self.download_dir, local_path))))
+                    for local_path, record in self.records.iteritems() if record[MANIFEST_MP])
+
+
+def is_synced(export, path, local_path, entry):
+    """
+    Return whether the local copy of a file is up to date with the remote file, according to the manifest.
+    An outdated local copy is removed, so that it is downloaded again
+    """
+    record = export.manifest.lookup(local_path)
+    if record is None or not os.path.exists(local_path):
+        return False
+
+    if entry is None:
+        export.pool.progress.message(u"The remote file is not available anymore. Keeping the local copy: {0}"
+                                     .format(local_path))
+        return True
+
+    if record[MANIFEST_PATH] == path and record[MANIFEST_SIZE] == entry[1] and \
+       record[MANIFEST_MTIME] == entry[2] and os.path.getsize(local_path) == entry[1]:
+        export.pool.progress.message(u"Skipping the download of unchanged path: {0}".format(local_path))
+        return True
+
+    export.pool.progress.message(u"The remote file has changed. Downloading it again: {0}".format(local_path))
+    os.remove(local_path)
+    return False
+
+
+class LinkRegistry(object):
+    """
+    Keep track of the remote files being downloaded, so that any later occurrence of the same file is
+    hardlinked to the first local copy instead of being downloaded again.
+    Files are identified by a key, such as their relative path or their remote device and inode
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Key -> local path of the first copy, and whether it is complete
+        self._copies = {}
+        # Key -> list of (relative path, local path, download directory) waiting for the first copy to complete
+        self._waiting = {}
+
+    def claim(self, key, path, local_path, download_dir):
+        """
+        Return None if the file must be downloaded to 'local_path', in which case 'release' must be called afterwards.
+        Otherwise, return the path of the complete copy to link to, or an empty string if the copy is still being
+        downloaded. In the latter case, the path will be linked when the download completes
+        """
+        with self._lock:
+            if key not in self._copies:
+                self._copies[key] = (local_path, False)
+                return None
+
+            copy_path, complete = self._copies[key]
+            if complete:
+                return copy_path
+
+            self._waiting.setdefault(key, []).append((path, local_path, download_dir))
+            return ""
+
+    def release(self, key, downloaded):
+        """
+        Mark the download of the file identified by 'key' as finished, and return the list of
+        (relative path, local path, download directory) waiting for it. If the download failed, the key is forgotten, so that the waiting paths can claim it again
+        """
+        with self._lock:
+            if downloaded:
+                self._copies[key] = (self._copies[key][0], True)
+            else:
+                del self._copies[key]
+            return self._waiting.pop(key, [])
+
+
+def link_file(source, target):
+    """
+    Make 'target' a hardlink to 'source'. If the filesystem does not allow it, copy the file instead.
+    Any existing 'target', such as a partial download, is replaced
+    """
+    try:
+        os.makedirs(os.path.dirname(target), DIRMODE)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    if os.path.exists(target) and os.path.samefile(source, target):
+        # Already linked by a previous run
+        return
+
+    # Link under a temporary name and rename, so that 'target' is replaced atomically
+    part_path = target + PART_SUFFIX
+    if os.path.lexists(part_path):
+        os.remove(part_path)
+    try:
+        os.link(source, part_path)
+    except OSError:
+        shutil.copy2(source, part_path)
+    os.rename(part_path, target)
+
+
+def get_size(index, path):
+    """
+    Return the size of a remote file according to the index, or 0 if it is unknown
+    """
+    entry = index.lookup(path) if index is not None else None
+    return entry[1] if entry is not None else 0
+
+
+def find_local_path(path, local_roots):
+    """
+    Return the location of the relative path in the first local directory containing it, or None if it is not
+    in any of them
+    """
+    for root in local_roots:
+        candidate = os.path.join(root, path)
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def copy_local_file(source_path, local_path, part_path, progress, resume):
+    """
+    Copy a file from a local mountpoint of the server's storage, using the fastest mechanism available:
+    a reflink (a copy-on-write clone) if the filesystem supports it, an in-kernel copy if the Python version
+    provides it, or a regular buffered copy otherwise.
+    Return the number of bytes copied, or None if the local file was already complete
+    """
+    size = os.path.getsize(source_path)
+    if resume and os.path.exists(local_path) and os.path.getsize(local_path) == size:
+        progress.message(u"Skipping the download of already-complete path: {0}".format(local_path))
+        progress(part_path, size, size)
+        return None
+
+    with open(source_path, 'rb') as source, open(part_path, 'wb') as target:
+        progress(part_path, size, 0)
+
+        cloned = False
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+                cloned = True
+            except (IOError, OSError):
+                # Not supported by the filesystem(s) involved
+                pass
+
+        if not cloned:
+            kernel_copy = getattr(os, "copy_file_range", None)
+            copied = 0
+            while copied < size:
+                length = 0
+                if kernel_copy is not None:
+                    try:
+                        length = kernel_copy(source.fileno(), target.fileno(), LOCAL_COPY_CHUNK_SIZE)
+                    except OSError:
+                        # E.g. across filesystems in older kernels. Use a regular copy from here on
+                        kernel_copy = None
+                        source.seek(copied)
+                        target.seek(copied)
+                        continue
+                else:
+                    data = source.read(LOCAL_COPY_CHUNK_SIZE)
+                    target.write(data)
+                    length = len(data)
+
+                if not length:
+                    raise IOError("Copied {0} bytes of '{1}', but it is {2} bytes long".format(copied, source_path, size))
+                copied += length
+                progress(part_path, size, copied)
+
+    progress(part_path, size, size)
+    shutil.copymode(source_path, part_path)
+    os.rename(part_path, local_path)
+    return size
+
+
+def is_segmented(entry, export):
+    """
+    Return whether the file with the given index entry is downloaded in segments
+    """
+    return entry is not None and export.segments > 1 and entry[1] >= export.segment_threshold
+
+
+def download_segmented(worker, remote_path, size, local_path, part_path, export):
+    """
+    Download a large file in several segments at once, each through its own SFTP channel on the worker's transport.
+    The segments are written into a partial file of the final size, and their progress is kept in a file next to
+    it, so that each segment continues where it was left when the download is resumed.
+    Return the number of bytes downloaded in this run, or None if the local file was already complete
+    """
+    if export.resume and os.path.exists(local_path) and os.path.getsize(local_path) == size:
+        export.pool.progress.message(u"Skipping the download of already-complete path: {0}".format(local_path))
+        export.pool.progress(part_path, size, size)
+        return None
+
+    download = SegmentedDownload(remote_path, size, part_path, export)
+    try:
+        status = download.run(worker)
+    except (IOError, OSError) as e:
+        if e.errno == errno.ENOENT:
+            # The file does not exist in this directory
+            raise SCPException(u"{0}: {1}".format(remote_path, e))
+        raise
+
+    if INTERRUPTED:
+        # The segments' state is kept to resume the download later
+        return 0
+    if not status:
+        raise IOError("The remote file '{0}' changed during the download".format(remote_path))
+
+    os.remove(download.state_path)
+    os.rename(part_path, local_path)
+    return size - download.resumed
+
+
+class SegmentedDownload(object):
+    """
+    State of a file downloaded in segments. Each segment is a [start, end, done] list, where 'done' is the offset
+    up to which the segment has been written
+    """
+
+    def __init__(self, remote_path, size, part_path, export):
+        self.remote_path = remote_path
+        self.size = size
+        self.part_path = part_path
+        self.state_path = part_path + SEGMENTS_SUFFIX
+        self.export = export
+        self.segments = None
+        self.mtime = None
+        # Bytes already downloaded by a previous run
+        self.resumed = 0
+        self._lock = threading.Lock()
+        self._last_save = 0
+
+    def run(self, worker):
+        """
+        Download the segments, verify them and return whether the file is complete.
+        The calling worker downloads the first segment, and helper threads the rest
+        """
+        stat = worker.sftp.stat(self.remote_path)
+        self.mtime = stat.st_mtime
+        if stat.st_size != self.size:
+            return False
+
+        self._load()
+
+        errors = []
+
+        def fetch(segment):
+            try:
+                sftp = paramiko.SFTPClient.from_transport(worker.transport, window_size=SSH_WINDOW_SIZE,
+                                                          max_packet_size=SSH_MAX_PACKET_SIZE)
+                try:
+                    self._fetch(sftp, segment, worker.limiter)
+                finally:
+                    sftp.close()
+            except Exception as e:
+                errors.append(e)
+
+        helpers = [ threading.Thread(target=fetch, args=(segment,)) for segment in self.segments[1:] ]
+        for helper in helpers:
+            helper.daemon = True
+            helper.start()
+        try:
+            self._fetch(worker.sftp, self.segments[0], worker.limiter)
+        finally:
+            for helper in helpers:
+                helper.join()
+            self._save(True)
+
+        if errors:
+            raise errors[0]
+        if INTERRUPTED:
+            return False
+
+        # Verify that every segment is complete and the remote file did not change in the meantime
+        for start, end, done in self.segments:
+            if done != end:
+                raise IOError("Segment {0}-{1} of '{2}' is incomplete".format(start, end, self.remote_path))
+        if os.path.getsize(self.part_path) != self.size:
+            raise IOError("The partial file '{0}' does not have {1} bytes".format(self.part_path, self.size))
+        stat = worker.sftp.stat(self.remote_path)
+        return stat.st_size == self.size and stat.st_mtime == self.mtime
+
+    def _load(self):
+        """
+        Read the state of a previous download of the same remote file, if resuming, or start a new one
+        """
+        if self.export.resume and os.path.exists(self.part_path):
+            try:
+                with open(self.state_path) as f:
+                    state = json.load(f)
+                if state["size"] == self.size and state["mtime"] == self.mtime and \
+                   os.path.getsize(self.part_path) == self.size:
+                    self.segments = state["segments"]
+                    self.resumed = sum(done - start for start, end, done in self.segments)
+                    return
+            except (IOError, ValueError, KeyError):
+                pass
+
+        length = int(math.ceil(self.size / float(self.export.segments)))
+        self.segments = [ [start, min(start + length, self.size), start] for start in range(0, self.size, length) ]
+        # Allocate the whole file, so that every segment can be written at its position
+        with open(self.part_path, "wb") as f:
+            f.truncate(self.size)
+        self._save(True)
+
+    def _save(self, force=False):
+        with self._lock:
+            now = time.time()
+            if not force and now - self._last_save < SEGMENT_STATE_INTERVAL:
+                return
+            self._last_save = now
+            with open(self.state_path, "w") as f:
+                json.dump({ "size": self.size, "mtime": self.mtime, "segments": self.segments }, f)
 
+    def _fetch(self, sftp, segment, limiter):
+        """
+        Download the rest of a segment, reading up to SEGMENT_WINDOW_SIZE bytes in advance
+        """
+        with sftp.open(self.remote_path, "rb") as remote_file, open(self.part_path, "r+b") as local_file:
+            local_file.seek(segment[2])
+            while segment[2] < segment[1] and not INTERRUPTED:
+                window_end = min(segment[2] + SEGMENT_WINDOW_SIZE, segment[1])
+                chunks = [ (offset, min(SEGMENT_CHUNK_SIZE, window_end - offset))
+                           for offset in range(segment[2], window_end, SEGMENT_CHUNK_SIZE) ]
+                for (offset, length), data in zip(chunks, remote_file.readv(chunks)):
+                    if len(data) != length:
+                        raise IOError("Read {0} bytes at offset {1} of '{2}', instead of {3}".format(
+                            len(data), offset, self.remote_path, length))
+                    if limiter is not None:
+                        limiter.consume(length)
+                    local_file.write(data)
+                # The state never gets ahead of the data in the file
+                local_file.flush()
+                segment[2] = window_end
+                self._progress()
+                self._save()
+
+    def _progress(self):
+        self.export.pool.progress(self.part_path, self.size,
+                                  sum(done - start for start, end, done in self.segments))
+
+
+def resume_path(worker, remote_path, size, local_path, part_path, progress):
+    """
+    Download 'remote_path' into 'local_path', continuing from any partial download left behind by a previous run.
+    The remote size is obtained from the server if 'size' is None.
+    Return the number of bytes downloaded in this run, or None if the local file was already complete.
+    Raise SCPException if the remote file does not exist
+    """
+    if size is None:
+        try:
+            size = worker.sftp.stat(remote_path).st_size
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise SCPException(u"{0}: {1}".format(remote_path, e))
+            raise
 
-def get_unique_path(path):
+    if os.path.exists(local_path):
+        local_size = os.path.getsize(local_path)
+        if local_size == size:
+            progress.message(u"Skipping the download of already-complete path: {0}".format(local_path))
+            progress(part_path, size, size)
+            return None
+        elif local_size < size:
+            # A partial file left by a version of this script that did not use temporary names
+            os.rename(local_path, part_path)
+        else:
+            progress.message(u"WARN: The local file '{0}' is larger than the remote one. Downloading it again..."
+                             .format(local_path), sys.stderr)
+            os.remove(local_path)
+
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset > size:
+        # The remote file must have changed. Start over
+        offset = 0
+    resumed = offset
+
+    if offset == 0:
+        worker.scp.get(remote_path, part_path)
+    else:
+        # SCP cannot start a transfer at an offset, but SFTP can
+        with worker.sftp.open(remote_path, 'rb') as remote_file:
+            remote_file.seek(offset)
+            if worker.limiter is None:
+                # Prefetching requests the whole file in the background, regardless of how fast it is read
+                remote_file.prefetch(size)
+            with open(part_path, 'ab') as local_file:
+                progress(part_path, size, offset)
+                while offset < size:
+                    data = remote_file.read(RESUME_BUFFER_SIZE)
+                    if not data:
+                        break
+                    if worker.limiter is not None:
+                        worker.limiter.consume(len(data))
+                    local_file.write(data)
+                    offset += len(data)
+                    progress(part_path, size, offset)
+
+        if offset != size:
+            raise IOError("Downloaded {0} bytes of '{1}', but it is {2} bytes long".format(offset, remote_path, size))
+
+    os.rename(part_path, local_path)
+    return size - resumed
+
+
+def get_unique_path(path, reserved=None, check_disk=True):
     """
     If the path already exists, add a suffix. Return the first non-existing path found
+    If a 'reserved' set is provided, the paths in it are considered as existing, and the returned
+    path is added to it. This way, paths can be assigned before the corresponding directories are created
+    If 'check_disk' is False, only the reserved paths are considered, so that the same paths are assigned
+    again when a previous download is resumed
     """
     i = 0
     end_path = path
 
-    while os.path.exists(end_path):
+    while (check_disk and os.path.exists(end_path)) or (reserved is not None and end_path in reserved):
         i += 1
         end_path = path + "({0})".format(i)
 
+    if reserved is not None:
+        reserved.add(end_path)
+
     return end_path
 
 BYTE_UNITS = " kMGTPEZY"
@@ -325,6 +1633,10 @@ def convert_si(number):
         return "{0:.2f} {1}{2}B".format(reduced, suffix, "i" if index else "")
 
 def progress(filename, size, sent):
+    # Files are downloaded under a temporary name, but show the final one
+    if filename.endswith(PART_SUFFIX):
+        filename = filename[:-len(PART_SUFFIX)]
+
     short=filename
     for i in range(2):
         short = os.path.dirname(short)
@@ -333,6 +1645,363 @@ def progress(filename, size, sent):
 
     print(u"\rDownloading file {0} ({1:.0f}% of {2})...".format(filename, 100 if size == 0 else float(sent*100)/size, convert_si(size)), end=" ")
 
+
+class ProgressReporter(object):
+    """
+    Aggregate the progress of the files being downloaded concurrently into a single status line.
+    Instances are called with the same arguments as the 'progress' function, so they can be used as the
+    progress callback of several SCPClient's at once. When only one file is being downloaded, the
+    output is the same as the 'progress' function's.
+    Without a status line, only the completed files are printed, so that several processes can share the output
+    """
+
+    def __init__(self, status_line=True):
+        self._status_line = status_line
+        self._lock = threading.Lock()
+        self._active = {}
+        self._done_files = 0
+        self._done_bytes = 0
+        self._last_print = 0
+        self._last_length = 0
+
+    def __call__(self, filename, size, sent):
+        with self._lock:
+            self._active[filename] = (size, sent)
+
+            # Do not flood the terminal: only refresh the line every PROGRESS_INTERVAL seconds
+            now = time.time()
+            if sent < size and now - self._last_print < PROGRESS_INTERVAL:
+                return
+            self._last_print = now
+            self._print()
+
+    def finish(self, filename):
+        with self._lock:
+            size, sent = self._active.pop(filename, (0, 0))
+            self._done_files += 1
+            self._done_bytes += sent
+            if self._active or not self._status_line:
+                self._clear()
+                if filename.endswith(PART_SUFFIX):
+                    filename = filename[:-len(PART_SUFFIX)]
+                print(u"\rFinished downloading file {0}".format(filename))
+                self._print()
+            else:
+                print("Done!")
+                self._last_length = 0
+
+    def message(self, text, file=None):
+        """
+        Print a line of text without mixing it with the status line, to the standard output or the given file
+        """
+        with self._lock:
+            self._clear()
+            # The cleared status line must not follow a message printed to another file
+            sys.stdout.flush()
+            print(u"\r{0}".format(text), file=file or sys.stdout)
+            if self._active:
+                self._print()
+            else:
+                self._last_length = 0
+
+    def _clear(self):
+        if self._status_line:
+            print(u"\r{0}".format(" " * self._last_length), end="")
+
+    def _print(self):
+        if not self._status_line:
+            return
+        if len(self._active) == 1:
+            filename, (size, sent) = next(self._active.iteritems())
+            progress(filename, size, sent)
+        else:
+            total = sum(size for size, sent in self._active.itervalues())
+            sent = sum(sent for size, sent in self._active.itervalues())
+            line = u"\rDownloading {0} files ({1:.0f}% of {2}). {3} files ({4}) completed...".format(
+                len(self._active), 100 if total == 0 else float(sent*100)/total, convert_si(total),
+                self._done_files, convert_si(self._done_bytes))
+            self._clear()
+            print(line, end=" ")
+            self._last_length = len(line)
+        sys.stdout.flush()
+
+
+class Telemetry(object):
+    """
+    Metrics of the files obtained in an export: how many bytes, from which directory and by which method, and how
+    much time was spent looking for them, transferring them and retrying. Each record is appended to a JSON lines
+    file, if given, as soon as the file is done, and all of them are summarized at the end of the export.
+    In the processes of a multi-process export, the records are put in a queue for the parent process instead
+    """
+
+    def __init__(self, metrics_file=None):
+        self.metrics_file = metrics_file
+        self.queue = None
+        self.records = []
+        # Time spent on the tasks that are not related to a single file, by name
+        self.timings = {}
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, path, root, method, size, lookup_time, transfer_time, retries, status):
+        record = { "time": time.time(),
+                   "path": path,
+                   "root": root,
+                   "method": method,
+                   "bytes": size,
+                   "lookup_seconds": round(lookup_time, 6),
+                   "transfer_seconds": round(transfer_time, 6),
+                   "rate": size / transfer_time if transfer_time > 0 else None,
+                   "retries": retries,
+                   "status": status }
+        if self.queue is not None:
+            self.queue.put(record)
+        else:
+            self._add(record)
+
+    def collect(self, queue):
+        """
+        Add the records put in a queue by other processes
+        """
+        while True:
+            try:
+                self._add(queue.get_nowait())
+            except Queue.Empty:
+                return
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.timings[name] = self.timings.get(name, 0) + seconds
+
+    def _add(self, record):
+        with self._lock:
+            self.records.append(record)
+            if self.metrics_file:
+                with open(self.metrics_file, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+
+    def _totals(self, key):
+        """
+        Return the number of files, bytes, seconds of transfer and retries of the records, grouped by 'key'
+        """
+        totals = {}
+        for record in self.records:
+            files, size, seconds, retries = totals.get(record[key], (0, 0, 0, 0))
+            totals[record[key]] = (files + 1, size + record["bytes"], seconds + record["transfer_seconds"],
+                                   retries + record["retries"])
+        return totals
+
+    def print_summary(self):
+        if not self.records:
+            return
+
+        wall_time = time.time() - self.start
+        line = u"{0:<50} {1:>8} {2:>14} {3:>10} {4:>14}"
+        for key, title in (("method", u"Method"), ("root", u"Source directory"), ("status", u"Status")):
+            print(line.format(title, u"Files", u"Size", u"Seconds", u"Rate"))
+            for value, (files, size, seconds, retries) in sorted(self._totals(key).iteritems()):
+                print(line.format(value or u"-", files, convert_si(size), u"{0:.1f}".format(seconds),
+                                  convert_si(int(size / seconds)) + u"/s" if seconds else u"-"))
+            print()
+
+        total_bytes = sum(record["bytes"] for record in self.records)
+        print(u"{0} files, {1} in {2:.1f} seconds ({3}/s)".format(
+            len(self.records), convert_si(total_bytes), wall_time, convert_si(int(total_bytes / wall_time))))
+        print(u"Seconds looking for files: {0:.1f}. Seconds transferring: {1:.1f}. Retries: {2}".format(
+            sum(record["lookup_seconds"] for record in self.records),
+            sum(record["transfer_seconds"] for record in self.records),
+            sum(record["retries"] for record in self.records)))
+        if self.timings:
+            print(u", ".join(u"Seconds {0}: {1:.1f}".format(name, seconds)
+                             for name, seconds in sorted(self.timings.iteritems())))
+        print()
+
+    def write_prometheus(self, path):
+        """
+        Write the totals in the Prometheus text format, atomically, as the textfile collector expects
+        """
+        lines = []
+
+        def metric(name, help_text, metric_type, samples):
+            lines.append(u"# HELP {0} {1}".format(name, help_text))
+            lines.append(u"# TYPE {0} {1}".format(name, metric_type))
+            for labels, value in samples:
+                label_text = u",".join(u'{0}="{1}"'.format(label, unicode(label_value).replace('\\', '\\\\').replace('"', '\\"'))
+                                       for label, label_value in sorted(labels.iteritems()))
+                lines.append(u"{0}{1} {2}".format(name, u"{" + label_text + u"}" if label_text else u"", value))
+
+        totals = {}
+        for record in self.records:
+            labels = (record["method"] or u"", record["root"] or u"", record["status"])
+            files, size, seconds, lookup, retries = totals.get(labels, (0, 0, 0, 0, 0))
+            totals[labels] = (files + 1, size + record["bytes"], seconds + record["transfer_seconds"],
+                              lookup + record["lookup_seconds"], retries + record["retries"])
+
+        def samples(position):
+            return [ ({ "method": method, "root": root, "status": status }, values[position])
+                     for (method, root, status), values in sorted(totals.iteritems()) ]
+
+        metric(u"mh_export_files_total", u"Files obtained by the export", u"counter", samples(0))
+        metric(u"mh_export_bytes_total", u"Bytes obtained by the export", u"counter", samples(1))
+        metric(u"mh_export_transfer_seconds_total", u"Seconds spent transferring files", u"counter", samples(2))
+        metric(u"mh_export_lookup_seconds_total", u"Seconds spent looking for files", u"counter", samples(3))
+        metric(u"mh_export_retries_total", u"Downloads tried again after a connection error", u"counter", samples(4))
+        metric(u"mh_export_task_seconds_total", u"Seconds spent on tasks not related to a single file", u"counter",
+               [ ({ "task": name }, seconds) for name, seconds in sorted(self.timings.iteritems()) ])
+        metric(u"mh_export_duration_seconds", u"Duration of the export", u"gauge", [ ({}, time.time() - self.start) ])
+
+        with open(path + PART_SUFFIX, "w") as f:
+            f.write(u"\n".join(lines).encode("utf-8") + "\n")
+        os.rename(path + PART_SUFFIX, path)
+
+
+class RateLimiter(object):
+    """
+    Token bucket limiting the combined rate of all the transfers that consume from it.
+    The maximum rate may depend on the time of the day, according to a schedule of (start, end, rate) tuples,
+    where start and end are minutes since midnight. A rate of 0 or None means no limit
+    """
+
+    def __init__(self, rate, schedule=()):
+        self._rate = rate
+        self._schedule = schedule
+        self._lock = threading.Lock()
+        self._tokens = 0
+        self._last = time.time()
+
+    def current_rate(self):
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self._schedule:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return rate
+        return self._rate
+
+    def consume(self, nbytes):
+        """
+        Take the given number of bytes from the bucket, blocking until the rate allows it
+        """
+        rate = self.current_rate()
+        if not rate:
+            return
+
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self._tokens + (now - self._last) * rate, rate * RATE_BURST_SECONDS)
+            self._last = now
+            # The bytes are taken anyway. The debt makes the following transfers wait, too
+            self._tokens -= nbytes
+            wait = -self._tokens / float(rate)
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Worker(object):
+    """
+    Clients owned by each of the workers in a DownloadPool.
+    The SCP client is always available. The SFTP session is only opened when some download needs it
+    """
+
+    def __init__(self, transport, progress, max_buff_size, limiter=None):
+        self.transport = transport
+        self.progress = progress
+        # RateLimiter shared by all the workers, if any
+        self.limiter = limiter
+        self.scp = SCPClient(transport, buff_size=SCP_BUFFER_SIZE, progress=progress, max_buff_size=max_buff_size,
+                             window_size=SSH_WINDOW_SIZE, max_packet_size=SSH_MAX_PACKET_SIZE,
+                             progress_interval=SCP_PROGRESS_INTERVAL, limiter=limiter)
+        self._sftp = None
+        self._sftp_refused = False
+
+    @property
+    def sftp(self):
+        if self._sftp is None:
+            self._sftp = paramiko.SFTPClient.from_transport(self.transport, window_size=SSH_WINDOW_SIZE,
+                                                            max_packet_size=SSH_MAX_PACKET_SIZE)
+        return self._sftp
+
+    def sftp_available(self):
+        """
+        Return whether the SFTP session can be opened. Some servers only allow SCP, so the downloads that prefer SFTP
+        fall back to it
+        """
+        if self._sftp is None and not self._sftp_refused:
+            try:
+                self.sftp
+            except paramiko.SSHException as e:
+                if not self.transport.is_active():
+                    # The connection was lost, rather than SFTP refused
+                    raise
+                self._sftp_refused = True
+                self.progress.message(u"WARN: Could not open an SFTP session ({0}). Downloading through SCP instead"
+                                      .format(e))
+        return not self._sftp_refused
+
+    def read_file(self, remote_path):
+        """
+        Read a whole remote file in memory, through SFTP or, if the server does not allow it, with 'cat'.
+        Raise IOError with errno ENOENT if the file does not exist
+        """
+        if self.sftp_available():
+            with self.sftp.open(remote_path, "rb") as f:
+                return f.read()
+        return read_remote_file(self.transport, remote_path)
+
+
+class DownloadPool(object):
+    """
+    Run the downloads in a bounded number of worker threads.
+    Each worker has its own clients and therefore uses its own channels. The workers are spread evenly across the
+    SSH transports given.
+    The functions submitted to the pool receive the worker's Worker instance as their first argument
+    """
+
+    def __init__(self, transports, jobs, progress, max_buff_size=DEFAULT_MAX_BUFFER_SIZE, limiter=None):
+        self.progress = progress
+        self._tasks = Queue.PriorityQueue()
+        self._lock = threading.Lock()
+        self._pending = 0
+        # Tasks of the same size run in the order they were submitted
+        self._submitted = 0
+
+        for i in range(jobs):
+            worker = threading.Thread(target=self._work,
+                                      args=(Worker(transports[i % len(transports)], progress, max_buff_size, limiter),),
+                                      name="download-{0}".format(i))
+            # Do not let the workers keep the program alive after the main thread exits
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue a task. The keyword argument 'size' indicates the number of bytes the task is expected to transfer,
+        if known. The largest tasks run first, so that the workers do not end up waiting for a single large file
+        """
+        with self._lock:
+            self._pending += 1
+            self._submitted += 1
+            self._tasks.put((-kwargs.get("size", 0), self._submitted, func, args))
+
+    def _work(self, worker):
+        while True:
+            size, order, func, args = self._tasks.get()
+            try:
+                # After an interruption, the remaining tasks are just discarded
+                if not INTERRUPTED:
+                    func(worker, *args)
+            except Exception as exc:
+                self.progress.message(u"ERROR ({0}) in {1}: {2}".format(type(exc).__name__,
+                                                                      threading.current_thread().name, exc), sys.stderr)
+            finally:
+                with self._lock:
+                    self._pending -= 1
+
+    def join(self):
+        # Queue.join() would block the signal handlers in Python 2, so poll the number of pending tasks instead
+        while self._pending:
+            time.sleep(POOL_POLL_INTERVAL)
+
 ######################################################################################################################################
 ######################################################################################################################################
 ########################################################### CODE OF SCPCLIENT ########################################################
@@ -351,6 +2020,7 @@ Utilities for sending files over ssh using the scp1 protocol.
 import locale
 import os
 import re
+import time
 from socket import timeout as SocketTimeout
 
 
@@ -425,13 +2095,16 @@ class SCPClient(object):
     (matching scp behaviour), but we make no attempt at symlinked directories.
     """
     def __init__(self, transport, buff_size=16384, socket_timeout=5.0,
-                 progress=None, sanitize=_sh_quote):
+                 progress=None, sanitize=_sh_quote, max_buff_size=None,
+                 window_size=None, max_packet_size=None, progress_interval=0,
+                 limiter=None):
         """
         Create an scp1 client.
 
         @param transport: an existing paramiko L{Transport}
         @type transport: L{Transport}
-        @param buff_size: size of the scp send buffer.
+        @param buff_size: size of the scp send buffer, and initial size of the
+            receive buffer.
         @type buff_size: int
         @param socket_timeout: channel socket timeout in seconds
         @type socket_timeout: float
@@ -440,9 +2113,28 @@ class SCPClient(object):
         @param sanitize: function - called with filename, should return
             safe or escaped string.  Uses _sh_quote by default.
         @type progress: function(string, int, int)
+        @param max_buff_size: size up to which the receive buffer grows while
+            the channel keeps filling it. Defaults to buff_size.
+        @type max_buff_size: int
+        @param window_size: SSH window size of the channels. Uses paramiko's
+            default if None.
+        @type window_size: int
+        @param max_packet_size: SSH maximum packet size of the channels. Uses
+            paramiko's default if None.
+        @type max_packet_size: int
+        @param progress_interval: minimum seconds between two progress calls
+            while receiving a file.
+        @type progress_interval: float
+        @param limiter: object whose consume(nbytes) method is called with
+            every chunk received, and may block to limit the transfer rate.
         """
         self.transport = transport
         self.buff_size = buff_size
+        self.max_buff_size = max(max_buff_size or buff_size, buff_size)
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self.progress_interval = progress_interval
+        self.limiter = limiter
         self.socket_timeout = socket_timeout
         self.channel = None
         self.preserve_times = False
@@ -471,7 +2163,8 @@ class SCPClient(object):
         @type preserve_times: bool
         """
         self.preserve_times = preserve_times
-        self.channel = self.transport.open_session()
+        self.channel = self.transport.open_session(
+            window_size=self.window_size, max_packet_size=self.max_packet_size)
         self._pushed = 0
         self.channel.settimeout(self.socket_timeout)
         scp_command = (b'scp -t ', b'scp -r -t ')[recursive]
@@ -522,7 +2215,8 @@ class SCPClient(object):
                                    asunicode(self._recv_dir))
         rcsv = (b'', b' -r')[recursive]
         prsv = (b'', b' -p')[preserve_times]
-        self.channel = self.transport.open_session()
+        self.channel = self.transport.open_session(
+            window_size=self.window_size, max_packet_size=self.max_packet_size)
         self._pushed = 0
         self.channel.settimeout(self.socket_timeout)
         self.channel.exec_command(b"scp" +
@@ -719,17 +2413,44 @@ class SCPClient(object):
             else:
                 self._progress(path, size, 0)
         buff_size = self.buff_size
+        max_buff_size = self.max_buff_size
+        # the received chunks are gathered in a reusable buffer, which is
+        # written to the file when full
+        write_buff = memoryview(bytearray(max_buff_size))
+        buffered = 0
         pos = 0
+        last_progress = time.time()
         chan.send(b'\x00')
         try:
             while pos < size:
                 # we have to make sure we don't read the final byte
-                if size - pos <= buff_size:
-                    buff_size = size - pos
-                file_hdl.write(chan.recv(buff_size))
-                pos = file_hdl.tell()
+                data = chan.recv(min(buff_size, size - pos))
+                if not data:
+                    # A connection problem, not a missing file, so that the download is tried again
+                    raise paramiko.SSHException('Channel closed while receiving')
+                length = len(data)
+                if buffered + length > max_buff_size:
+                    file_hdl.write(write_buff[:buffered])
+                    buffered = 0
+                write_buff[buffered:buffered + length] = data
+                buffered += length
+                pos += length
+                # the channel had more data ready than requested: read more
+                # at once next time
+                if length == buff_size and buff_size < max_buff_size:
+                    buff_size = min(buff_size * 2, max_buff_size)
+                # not reading the channel while throttled makes the server
+                # wait for the window to be adjusted
+                if self.limiter:
+                    self.limiter.consume(length)
                 if self._progress:
-                    self._progress(path, size, pos)
+                    now = time.time()
+                    if now - last_progress >= self.progress_interval:
+                        last_progress = now
+                        self._progress(path, size, pos)
+            file_hdl.write(write_buff[:buffered])
+            if self._progress:
+                self._progress(path, size, pos)
 
             msg = chan.recv(512)
             if msg and msg[0:1] != b'\x00':
@@ -801,10 +2522,107 @@ class SCPException(Exception):
 ######################################################################################################################################
 
 
+def connect_ssh(ssh_url, user, password=None, ciphers=None):
+    """
+    Open an SSH connection to the server. If a list of ciphers is given, the rest are disabled
+    """
+    ssh = paramiko.SSHClient()
+    ssh.load_system_host_keys()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+    if ciphers:
+        # Only passed when needed, since paramiko versions before 2.6 do not accept this argument
+        disabled = [ cipher for cipher in get_supported_ciphers() if cipher not in ciphers ]
+        ssh.connect(ssh_url, username=user, password=password, disabled_algorithms={ "ciphers": disabled })
+    else:
+        ssh.connect(ssh_url, username=user, password=password)
+    return ssh
+
+
+def get_supported_ciphers():
+    """
+    Return the SSH ciphers supported by paramiko, in its order of preference
+    """
+    sock = socket.socket()
+    try:
+        return list(paramiko.Transport(sock).get_security_options().ciphers)
+    finally:
+        sock.close()
+
+
+def get_limiter(args, share=1):
+    """
+    Return the RateLimiter for the transfer rates in the arguments, or None if they are not limited.
+    'share' is the number of processes among which the rates are split
+    """
+    if not args.max_rate and not args.rate_schedule:
+        return None
+    return RateLimiter(args.max_rate and args.max_rate // share,
+                       [ (start, end, rate // share) for start, end, rate in args.rate_schedule or () ])
+
+
+def export_in_processes(plan, args, ssh_url, ssh_password, export):
+    """
+    Split a plan among several processes, each of them with its own SSH connections and workers, and wait for them.
+    The occurrences of the same file go to the same process, so that the duplicates are still linked.
+    Return 0 if all the processes succeeded, or 1 otherwise
+    """
+    parts = [ [] for i in range(args.processes) ]
+    for entry in plan:
+        if export.links is not None:
+            key = get_link_key(entry[PLAN_PATH],
+                               export.index.lookup(entry[PLAN_PATH]) if export.index is not None else None)
+        else:
+            key = entry[PLAN_DIR]
+        parts[hash(key) % args.processes].append(entry)
+
+    processes = [ multiprocessing.Process(target=export_plan_part, args=(part, args, ssh_url, ssh_password, export),
+                                          name="export-{0}".format(i))
+                  for i, part in enumerate(parts) if part ]
+
+    # The processes send the metrics of their downloads back through a queue
+    export.telemetry.queue = multiprocessing.Queue()
+    for process in processes:
+        process.start()
+    queue, export.telemetry.queue = export.telemetry.queue, None
+
+    # Joining without a timeout would block the signal handlers in Python 2
+    while any(process.is_alive() for process in processes):
+        export.telemetry.collect(queue)
+        time.sleep(POOL_POLL_INTERVAL)
+    export.telemetry.collect(queue)
+
+    return 1 if any(process.exitcode for process in processes) else 0
+
+
+def export_plan_part(plan, args, ssh_url, ssh_password, export):
+    """
+    Download part of a plan in a process of its own. The export's settings are inherited from the parent process,
+    but not its connections, workers or registry of downloaded files
+    """
+    try:
+        connections = [ connect_ssh(ssh_url, args.ssh_user, ssh_password, args.ciphers) for i in range(args.connections) ]
+        export.pool = DownloadPool([ connection.get_transport() for connection in connections ], args.jobs,
+                                   ProgressReporter(status_line=False), args.buffer_size,
+                                   get_limiter(args, args.processes))
+        if export.links is not None:
+            export.links = LinkRegistry()
+
+        submit_plan(export.pool, plan, export, args.tar)
+        export.pool.join()
+    except Exception as exc:
+        print(u"ERROR ({0}) in {1}: {2}".format(type(exc).__name__, multiprocessing.current_process().name, exc),
+              file=sys.stderr)
+        sys.exit(1)
+
+    sys.exit(1 if INTERRUPTED else 0)
+
+
 def main(args):
 
-    global INTERRUPTED, progress
+    global INTERRUPTED
 
+    series_id = None
     try:
 
         # Process server URL
@@ -823,35 +2641,36 @@ def main(args):
 
 
         # Create a SSH session to the server
-        ssh = paramiko.SSHClient()
-        ssh.load_system_host_keys()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
+        ssh_password = None
         try:
             # Try passwordless authentication first
-            ssh.connect(ssh_url, username=args.ssh_user)
+            ssh = connect_ssh(ssh_url, args.ssh_user, None, args.ciphers)
         except paramiko.SSHException:
             # If that fails, request the password to log in
             prompt = "Enter the SSH password for user '{0}' at {1}: ".format(args.ssh_user if args.ssh_user else getpass.getuser(), ssh_url)
-            ssh.connect(ssh_url, username=args.ssh_user, password=getpass.getpass(prompt))
-
-        # Create the SCP client to get the files
-        scp = SCPClient(ssh.get_transport(), progress=progress)
+            ssh_password = getpass.getpass(prompt)
+            ssh = connect_ssh(ssh_url, args.ssh_user, ssh_password, args.ciphers)
 
         # Get the directories where to look for the files to download
         dirs = get_dirs(ssh, LOCATION_KEYS, args.config, args.extra_dirs)
 
-        # Read the elements published in the search index and create an XML document tree out of the response
-        if not args.digest_user:
-            setattr(args, "digest_user", raw_input("Enter the digest authentication user: "))
+        telemetry = Telemetry(args.metrics)
 
-        mp_list_str = curl(search_url,
-                           args.endpoint,
-                           query_params={ QUERY_PARAM_SERIES_ID: args.series_id },
-                           user=args.digest_user,
-                           password=getpass.getpass("Enter the digest authentication password: "))
+        if args.no_index:
+            index = None
+        else:
+            # List the files in those directories at once, instead of looking for each file in every directory
+            print(u"Indexing the files in the remote directories...", end=" ")
+            sys.stdout.flush()
+            index_start = time.time()
+            index = RemoteIndex(ssh.get_transport(), dirs)
+            telemetry.add_time(TIMING_INDEX, time.time() - index_start)
+            print(u"{0} files found".format(len(index)))
 
-        document = etree.fromstring(mp_list_str)
+        if not args.digest_user:
+            setattr(args, "digest_user", raw_input("Enter the digest authentication user: "))
+        if not args.digest_pass:
+            setattr(args, "digest_pass", getpass.getpass("Enter the digest authentication password: "))
 
         # Do not interrupt the program immediately after a keyboard interrupt
         INTERRUPTED = False
@@ -861,48 +2680,102 @@ def main(args):
         if args.tags is not None:
             args.tags = set(args.tags)
 
-        # For every mediapackage in the results...
-        mp = None
-        for mp in document.iter('{{{0}}}mediapackage'.format(MP_NAMESPACE)):
-            if INTERRUPTED:
-                interrupted()
-            mp_title = mp.find('{{{0}}}title'.format(MP_NAMESPACE)).text.replace("/", "_")
-            mp_dir = get_unique_path(os.path.join(args.download_dir, mp_title))
-
-            matching_tracks = [ track for track in mp.iter('{{{0}}}track'.format(MP_NAMESPACE))
-                                if (not args.flavors or track.get("type") in args.flavors) and
-                                (not args.tags or args.tags.intersection([ tag.text for tag in track.iterfind('.//{{{0}}}tag'.format(MP_NAMESPACE))]))]
-
-            # Iterate through the tracks in this mediapackage
-            if matching_tracks:
-                for track in matching_tracks:
-                    if INTERRUPTED:
-                        interrupted()
-
-                    # Get this track's URL
-                    track_url = track.find('{{{0}}}url'.format(MP_NAMESPACE)).text
+        # The downloads run in a pool of workers, each of them with its own SCP channel, while the next pages of
+        # the search results are being fetched
+        limiter = get_limiter(args)
+        # The workers are spread across several SSH connections, if requested, because each of them encrypts
+        # in a single thread
+        if args.processes == 1:
+            connections = [ssh] + [ connect_ssh(ssh_url, args.ssh_user, ssh_password, args.ciphers)
+                                    for i in range(args.connections - 1) ]
+        else:
+            # The processes open their own connections
+            connections = [ssh]
+        pool = DownloadPool([ connection.get_transport() for connection in connections ], args.jobs,
+                            ProgressReporter(), args.buffer_size, limiter)
+        export = Export(pool, dirs, index, args.resume, None if args.no_links else LinkRegistry(),
+                        args.local_roots or (), args.renditions, args.tar, args.segments, args.segment_threshold,
+                        Manifest(args.download_dir), args.sync, telemetry, args.retries)
+
+        # The export is planned in advance to split it among several processes
+        planning = args.plan or args.processes > 1
+
+        if args.from_plan:
+            plan = load_plan(args.from_plan, args.download_dir)
+            if not planning:
+                submit_plan(pool, plan, export, args.tar)
+        else:
+            # Queue the downloads of every mediapackage in the results as soon as it is read, unless only a plan is made
+            # All the series share the same pool, so the workers are kept busy across the series boundaries
+            plan = []
+            # The planner reads the SMIL files through a client of its own, with the same fallbacks as the workers
+            reader = Worker(ssh.get_transport(), pool.progress, args.buffer_size) if planning else None
+            # In sync mode, the mediapackages downloaded before are stored in the same directories again
+            known_dirs = export.manifest.mediapackage_dirs() if args.sync else {}
+            mp_dirs = set(known_dirs.itervalues())
+            for series_id in args.series_ids:
+                if INTERRUPTED:
+                    break
+
+                if len(args.series_ids) > 1:
+                    # Each series gets its own subdirectory
+                    series_dir = os.path.join(args.download_dir, series_id)
+                else:
+                    series_dir = args.download_dir
+
+                for mp_id, mp_dir, tracks in get_series_tracks(search_url, args, series_id, series_dir, mp_dirs, known_dirs,
+                                                               export.telemetry):
+                    if planning:
+                        plan.extend(plan_tracks(reader.read_file, export, mp_id, tracks, mp_dir))
+                    elif args.renditions != RENDITIONS_ALL or any(urlpath.splitext(path)[1] == ".smil"
+                                                                  for path, flavor, bitrate in tracks):
+                        # The files to download are chosen in a worker, because it needs to read the SMIL files
+                        pool.submit(download_mediapackage, mp_id, tracks, mp_dir, export, size=SELECTION_PRIORITY)
+                    elif args.tar:
+                        # The whole mediapackage is transferred in one stream
+                        pool.submit(download_tar, [ path for path, flavor, bitrate in tracks ], mp_dir, export,
+                                    size=sum(get_size(index, path) for path, flavor, bitrate in tracks))
+                    else:
+                        for path, flavor, bitrate in tracks:
+                            pool.submit(download_path, path, mp_dir, export, size=get_size(index, path))
+
+            if args.plan:
+                if INTERRUPTED:
+                    interrupted()
+
+                print_plan(plan, measure_throughput(ssh.get_transport(), plan, args.jobs), args.jobs, export)
+                if args.plan_file:
+                    save_plan(plan, args.plan_file, args.download_dir)
+                    print(u"\nPlan saved to '{0}'. Run the export with '--from_plan {0}'".format(args.plan_file))
+                if export.selection_failures:
+                    print(u"ERROR: The files of {0} mediapackage(s) could not be chosen, so all their tracks were planned: {1}"
+                          .format(len(export.selection_failures), u", ".join(export.selection_failures)), file=sys.stderr)
+                    return 1
+                return
 
-                    # Get the relative path of the resource in the remote server
-                    rel_path = get_relative_path_from_url(track_url)
+        if args.processes > 1:
+            status = export_in_processes(plan, args, ssh_url, ssh_password, export)
+        else:
+            status = 0
+            pool.join()
 
-                    download_path(scp, rel_path, mp_dir, dirs)
+        print()
+        telemetry.print_summary()
+        if args.prometheus:
+            telemetry.write_prometheus(args.prometheus)
 
-                print()
-            else:
-                print(u"No matching tracks found in mediapackage '{0}': {1}\n".format(mp.get("id"), mp_title), file=sys.stderr)
+        if export.selection_failures:
+            print(u"ERROR: The files of {0} mediapackage(s) could not be chosen, so all their tracks were downloaded: {1}"
+                  .format(len(export.selection_failures), u", ".join(export.selection_failures)), file=sys.stderr)
+            status = 1
 
-        if mp is None:
-            print(u"The search returned no mediapackages for the series '{0}".format(args.series_id))
+        if INTERRUPTED:
+            interrupted()
 
-        if DELETE_SMILS:
-            for smil in smils_to_delete:
-                try:
-                    os.remove(smil)
-                except Exception as e:
-                    print(u"Received exception {0} while deleting path '{1}': {2}".format(e.__class__.__name__, smil, e))
+        return status
 
     except pycurl.error as err:
-        print(u"ERROR: Could not get the list of published mediapackages in the series '{0}': {1}".format(args.series_id, err),
+        print(u"ERROR: Could not get the list of published mediapackages in the series '{0}': {1}".format(series_id, err),
               file=sys.stderr)
         return 1
     except gaierror as err:
@@ -913,21 +2786,119 @@ def main(args):
         print(u"ERROR ({0}): {1}".format(type(exc).__name__, exc), file=sys.stderr)
         return 1
 
+def positive_int(value):
+    """
+    Parse a strictly positive integer argument, such as the number of parallel downloads
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("'{0}' is not an integer".format(value))
+    if number < 1:
+        raise argparse.ArgumentTypeError("'{0}' is not a positive number".format(value))
+    return number
+
+
+def non_negative_int(value):
+    """
+    Parse an integer argument that may be 0 but not negative, such as the number of retries
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("'{0}' is not an integer".format(value))
+    if number < 0:
+        raise argparse.ArgumentTypeError("'{0}' is a negative number".format(value))
+    return number
+
+
+def byte_count(value):
+    """
+    Parse a number of bytes, or bytes per second, optionally followed by one of the suffixes in BYTE_SUFFIXES
+    """
+    match = re.match(r"^(\d+(?:\.\d+)?)([{0}]?)$".format("".join(BYTE_SUFFIXES)), value.strip())
+    if not match:
+        raise argparse.ArgumentTypeError("'{0}' is not a valid number of bytes".format(value))
+    return int(float(match.group(1)) * BYTE_SUFFIXES.get(match.group(2), 1))
+
+
+def rate_schedule(value):
+    """
+    Parse a period of the day with its own transfer rate, in the format HH:MM-HH:MM=RATE
+    """
+    match = re.match(r"^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(.+)$", value.strip())
+    if not match or int(match.group(1)) > 24 or int(match.group(3)) > 24 or \
+       int(match.group(2)) > 59 or int(match.group(4)) > 59:
+        raise argparse.ArgumentTypeError("'{0}' is not a valid schedule. Use the format HH:MM-HH:MM=RATE".format(value))
+    return (int(match.group(1)) * 60 + int(match.group(2)),
+            int(match.group(3)) * 60 + int(match.group(4)),
+            byte_count(match.group(5)))
+
+
+def renditions_mode(value):
+    """
+    Parse the renditions to download: one of the RENDITIONS_* modes or a maximum bitrate
+    """
+    if value in (RENDITIONS_BEST, RENDITIONS_LOWEST, RENDITIONS_ALL):
+        return value
+    try:
+        return positive_int(value)
+    except argparse.ArgumentTypeError:
+        raise argparse.ArgumentTypeError("'{0}' is not one of '{1}', '{2}', '{3}' or a bitrate"
+                                         .format(value, RENDITIONS_BEST, RENDITIONS_LOWEST, RENDITIONS_ALL))
+
+
+def cipher_list(value):
+    """
+    Parse a comma-separated list of SSH ciphers, which must be supported by paramiko
+    """
+    ciphers = [ cipher.strip() for cipher in value.split(",") if cipher.strip() ]
+    supported = get_supported_ciphers()
+    unsupported = [ cipher for cipher in ciphers if cipher not in supported ]
+    if not ciphers or unsupported:
+        raise argparse.ArgumentTypeError("Unsupported cipher(s) '{0}'. The supported ones are: {1}".format(
+            "', '".join(unsupported), ", ".join(supported)))
+    return ciphers
+
+
+# Custom action to expand the series IDs given as '@file' into the IDs contained in the file
+class series_list(argparse.Action):
+    def __call__(self, parser, namespace, values, option_string=None):
+        if not values:
+            # Only valid with '--from_plan', which is checked after parsing
+            setattr(namespace, self.dest, [])
+            return
+
+        series_ids = []
+        for value in values:
+            if value.startswith('@'):
+                try:
+                    with open(value[1:], 'r') as series_file:
+                        for line in series_file:
+                            # Ignore empty lines, comments and everything after the first inner whitespace
+                            fields = line.split()
+                            if fields and not fields[0].startswith('#'):
+                                series_ids.append(fields[0])
+                except IOError as e:
+                    raise argparse.ArgumentError(self, "Could not read the series file '{0}': {1}".format(value[1:], e))
+            else:
+                series_ids.append(value)
+
+        if not series_ids:
+            raise argparse.ArgumentError(self, "No series IDs were provided")
+
+        # Remove duplicates while keeping the order
+        seen = set()
+        setattr(namespace, self.dest, [ s for s in series_ids if not (s in seen or seen.add(s)) ])
+
+
 # Custom action to check the directory provided as a parameter
 class checkdir(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
-        # Try to create the output directory
-        try:
-            os.makedirs(values, DIRMODE)
-        except OSError:
-            # If the path exists, and it's a directory, check if it's empty
-            if os.path.isdir(values):
-                if os.listdir(values):
-                    raise argparse.ArgumentError(self, "The directory '{0}' is not empty.".format(values))
-            elif os.path.exists(values):
-                raise argparse.ArgumentError(self, "'{0}' already exists and is not a directory".format(values))
-            else:
-                raise argparse.ArgumentError(self, "Unable to create directory '{0}'. Please check whether the path is valid and the script has permission to create it".format(values))
+        # If the path exists, it must be a directory. Whether it must be empty, or be created at all, depends on
+        # other arguments, so that is checked after parsing
+        if os.path.exists(values) and not os.path.isdir(values):
+            raise argparse.ArgumentError(self, "'{0}' already exists and is not a directory".format(values))
 
         setattr(namespace, self.dest, values)
 
@@ -935,12 +2906,16 @@ class checkdir(argparse.Action):
 if __name__ == '__main__':
 
     # Argument parser
-    parser = argparse.ArgumentParser(description="Download all the published videos in a Matterhorn series")
+    parser = argparse.ArgumentParser(description="Download all the published videos in one or more Matterhorn series")
 
     parser.add_argument('server_url', help='The URL of the engage server where the videos will be downloaded from')
-    parser.add_argument('series_id', help='The ID of the series to which the videos that should be downloaded belong')
+    parser.add_argument('series_ids', metavar='series_id', nargs='*', action=series_list,
+                        help='The ID of the series to which the videos that should be downloaded belong. Several series can be \
+                        specified. A value starting with \'@\' is the name of a file containing one series ID per line. When \
+                        more than one series is downloaded, each of them is stored in a subdirectory named after its ID. \
+                        Required unless \'--from_plan\' is used')
     # We are only interested in file names, but this way the parser makes sure those files exist
-    parser.add_argument('download_dir', action=checkdir, help='The destination directory name. It must not exist or be empty')
+    parser.add_argument('download_dir', action=checkdir, help='The destination directory name. It must not exist or be empty, unless \'--resume\' or \'--sync\' are used')
     parser.add_argument('-s', '--ssh_url', help='The SSH-reachable server URL, if the public URL does not allow it')
     parser.add_argument('-u', '--ssh_user', help='The SSH user to connect to the server')
     parser.add_argument('-c', '--config', default=DEFAULT_CONF_FILE, help='Absolute path of the Matterhorn configuration file in the remote server. (Default: ''{0}'')'
@@ -949,18 +2924,126 @@ if __name__ == '__main__':
                         help='Endpoint, relative to the server URL, that should return the mediapackages belonging to the provided series. (Default: ''{0}'')'
                         .format(DEFAULT_SEARCH_ENDPOINT))
     parser.add_argument('-U', '--digest_user', help='User to authenticate with the Matterhorn endpoint in the server')
+    parser.add_argument('-p', '--digest_pass', help='Password to authenticate with the Matterhorn endpoint in the server')
     parser.add_argument('-d', '--directory', action="append", dest="extra_dirs",
                         help='Add an additional directory where the media files will be searched for. Can be specified several times.\n\
                         Please note that the directories \'download.dir\' and \'streaming.dir\' in the Matterhorn server configuration \
                         will always be inspected by default')
+    parser.add_argument('-l', '--local_root', action="append", dest="local_roots",
+                        help='A local directory where the files are looked for before downloading them from the server, \
+                        such as a mountpoint of the server\'s download or streaming directory. Paths are resolved relative to it \
+                        as they are relative to the server\'s directories. Can be specified several times')
     parser.add_argument('-f', '--flavor', action="append", dest="flavors",
                         help='Download only the elements with the indicated flavor. It can be specified several times, in order to download\n\
                         elements with different flavors')
     parser.add_argument('-t', '--tag', action="append", dest="tags",
                         help='Download only the elements with the indicated tag. It can be specified several times, in order to download\n\
                         elements with different tags or restrict the number of elements matched by the \'--flavor\' parameter')
+    parser.add_argument('-B', '--renditions', type=renditions_mode, default=RENDITIONS_ALL,
+                        help='Which of the files with the same flavor in a mediapackage are downloaded, considering both the \
+                        tracks and the renditions in the SMIL files: \'{0}\' for the highest bitrate, \'{1}\' for the lowest, \
+                        \'{2}\' for all of them, or a number for the highest bitrate not exceeding it, in bits per second. \
+                        Files whose bitrate is unknown are always downloaded. (Default: \'{2}\')'
+                        .format(RENDITIONS_BEST, RENDITIONS_LOWEST, RENDITIONS_ALL))
+    parser.add_argument('-I', '--no_index', action="store_true",
+                        help='Do not index the files in the remote directories before downloading. Instead, look for each file \
+                        in every directory in turn. This may be faster when the directories contain many more files than the series')
+    parser.add_argument('-L', '--no_links', action="store_true",
+                        help='Download every occurrence of the same remote file. By default, only the first occurrence is \
+                        downloaded and the rest are hardlinked to it. Files are considered the same when they have the same \
+                        relative path or, if the remote files are indexed, the same device and inode in the remote server')
+    parser.add_argument('-j', '--jobs', type=positive_int, default=DEFAULT_JOBS,
+                        help='Number of files to download in parallel, each of them through its own channel in the SSH connection. \
+                        (Default: {0})'.format(DEFAULT_JOBS))
+    parser.add_argument('-C', '--connections', type=positive_int, default=DEFAULT_CONNECTIONS,
+                        help='Number of SSH connections the parallel downloads are spread across. Each connection encrypts its \
+                        data in a single thread, so several connections can use more CPU cores. (Default: {0})'
+                        .format(DEFAULT_CONNECTIONS))
+    parser.add_argument('-X', '--processes', type=positive_int, default=DEFAULT_PROCESSES,
+                        help='Number of processes the export is split into, each with its own \'--connections\' and \'--jobs\', \
+                        after planning it as \'--plan\' does. The transfer rates are divided among the processes. (Default: {0})'
+                        .format(DEFAULT_PROCESSES))
+    parser.add_argument('-x', '--ciphers', type=cipher_list,
+                        help='Comma-separated list of the SSH ciphers allowed in the connections, e.g. aes128-ctr. The rest are \
+                        disabled. By default, the server and the client negotiate any cipher they both support')
+    parser.add_argument('-P', '--page_size', type=positive_int, default=DEFAULT_PAGE_SIZE,
+                        help='Number of mediapackages requested in every page of the search results. (Default: {0})'
+                        .format(DEFAULT_PAGE_SIZE))
+    parser.add_argument('-b', '--buffer_size', type=positive_int, default=DEFAULT_MAX_BUFFER_SIZE,
+                        help='Maximum size, in bytes, of the chunks read from the SSH channels. The chunks start at {0} bytes and grow \
+                        up to this size while the server keeps them full. (Default: {1})'.format(SCP_BUFFER_SIZE, DEFAULT_MAX_BUFFER_SIZE))
+    parser.add_argument('-T', '--tar', action="store_true",
+                        help='Transfer all the files in a mediapackage, or all the renditions in a SMIL file, through a single tar \
+                        stream, instead of one SCP transfer per file. This is much faster for mediapackages with many small files. \
+                        Requires the remote index and the \'tar\' command in the server')
+    parser.add_argument('-n', '--plan', action="store_true",
+                        help='Do not download anything. Instead, resolve every file to download through the remote index and \
+                        report the number of files, bytes and the estimated duration of the export, by flavor')
+    parser.add_argument('-N', '--plan_file', metavar='PLAN_FILE',
+                        help='Save the plan made with \'--plan\' to this file as JSON, to run it later with \'--from_plan\'. \
+                        Implies \'--plan\'')
+    parser.add_argument('-F', '--from_plan', metavar='PLAN_FILE',
+                        help='Download the files in a plan saved with \'--plan\', instead of searching the series again. \
+                        The series IDs are not needed, and ignored if given')
+    parser.add_argument('-m', '--max_rate', type=byte_count,
+                        help='Maximum transfer rate, in bytes per second, shared by all the parallel downloads. The suffixes \
+                        k, M and G (powers of 1024) are accepted, e.g. 200M. By default, the rate is not limited')
+    parser.add_argument('-R', '--rate_schedule', action="append", type=rate_schedule,
+                        help='Maximum transfer rate during a time of the day, in the format HH:MM-HH:MM=RATE, e.g. 08:00-20:00=200M. \
+                        A rate of 0 means no limit. The periods may span midnight. Outside all the periods, \'--max_rate\' applies. \
+                        Can be specified several times')
+    parser.add_argument('-g', '--segments', type=positive_int, default=DEFAULT_SEGMENTS,
+                        help='Number of segments of the large files downloaded at once, each through its own SFTP channel. \
+                        A value of 1 disables the segmented downloads. Requires the remote index. If the server does not \
+                        allow SFTP, the files are downloaded through SCP instead. (Default: {0})'
+                        .format(DEFAULT_SEGMENTS))
+    parser.add_argument('-G', '--segment_threshold', type=byte_count, default=DEFAULT_SEGMENT_THRESHOLD,
+                        help='Minimum size of the files downloaded in segments. The suffixes k, M and G are accepted. \
+                        (Default: {0})'.format(convert_si(DEFAULT_SEGMENT_THRESHOLD)))
+    parser.add_argument('-S', '--sync', action="store_true",
+                        help='Update a previous export in the same directory: download only the files that are new or have \
+                        changed since they were recorded in its manifest, \'{0}\'. Implies \'--resume\' and requires the \
+                        remote index'.format(MANIFEST_FILE))
+    parser.add_argument('-a', '--retries', type=non_negative_int, default=DEFAULT_RETRIES,
+                        help='Number of times a download is tried again after a connection error. (Default: {0})'
+                        .format(DEFAULT_RETRIES))
+    parser.add_argument('-M', '--metrics', metavar='METRICS_FILE',
+                        help='Append the metrics of every file obtained to this file, as JSON lines: bytes, method, source \
+                        directory, seconds spent looking for the file and transferring it, rate and retries')
+    parser.add_argument('-O', '--prometheus', metavar='TEXTFILE',
+                        help='Write the totals of the metrics to this file at the end of the export, in the text format of the \
+                        Prometheus node exporter\'s textfile collector')
+    parser.add_argument('-r', '--resume', action="store_true",
+                        help='Resume a previous download into the same directory. Complete files are skipped and partial \
+                        ones are continued from where they were left')
 
 #    print(parser.parse_args())
 #    exit(0)
 
-    sys.exit(main(parser.parse_args()))
+    args = parser.parse_args()
+    if args.sync:
+        args.resume = True
+    if args.plan_file:
+        args.plan = True
+    if not args.series_ids and not args.from_plan:
+        parser.error("At least one series ID is required, unless '--from_plan' is used")
+    if not args.plan and os.path.isdir(args.download_dir) and os.listdir(args.download_dir) and not args.resume:
+        parser.error("The directory '{0}' is not empty.".format(args.download_dir))
+    if args.tar and args.no_index:
+        parser.error("'--tar' cannot be used together with '--no_index'")
+    if args.sync and args.no_index:
+        parser.error("'--sync' cannot be used together with '--no_index'")
+    if args.plan and args.no_index:
+        parser.error("'--plan' cannot be used together with '--no_index'")
+    if args.plan and args.from_plan:
+        parser.error("'--plan' cannot be used together with '--from_plan'")
+
+    if not args.plan:
+        # Try to create the output directory. A plan does not need it
+        try:
+            os.makedirs(args.download_dir, DIRMODE)
+        except OSError:
+            if not os.path.isdir(args.download_dir):
+                parser.error("Unable to create directory '{0}'. Please check whether the path is valid and the script has permission to create it".format(args.download_dir))
+
+    sys.exit(main(args))
@@ -13,15 +13,31 @@ import getpass
 import os
 import re
 import shutil
+import sqlite3
+import threading
 import time
 import sys
 import urlparse
+import Queue
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Backport of os.scandir for Python 2
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from collections import Counter
 from lxml import etree
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPDigestAuth
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, RequestException
+
+import oc_limiter
 
 # List of directories under the given "mountpoint", where distributed mediapackage will be searched
 # and retracted from.
@@ -39,14 +55,54 @@ DISTRIBUTION_FILES = [
     ('streaming/mh_default_org', '^engage-player_{id}_present')
 ]
 
+# Directory where the distribution directories are moved to be deleted in the background, when
+# requested. There is one in the top directory of each filesystem under the mountpoint
+TRASH_DIR = '.trash'
+
+# Suffix added to the paths in the trash that are taken already
+TRASH_SUFFIX_REGEXP = re.compile(r'\.~\d+~$')
+
+# Default number of directories deleted at the same time from the trash
+DEFAULT_PURGE_JOBS = 2
+
+# Number of files deleted from the trash between two pauses, and length of the pauses in seconds,
+# so that the purge does not hog the storage
+PURGE_BATCH_SIZE = 100
+PURGE_PAUSE = 0.05
+
+# Names of the deletion steps, in the order they are performed, as recorded in the journal
+STEP_UNPUBLISH = 'unpublish'
+STEP_RETRACT = 'retract'
+STEP_WORKFLOWS = 'workflows'
+STEP_ARCHIVE = 'archive'
+STEPS = [STEP_UNPUBLISH, STEP_RETRACT, STEP_WORKFLOWS, STEP_ARCHIVE]
+
+# Outcomes of a deletion step, as recorded in the journal
+STEP_DONE = 'done'
+STEP_FAILED = 'failed'
+
+# Group matching any MP ID in the regexps in DISTRIBUTION_FILES, used to index those directories
+DISTRIBUTION_ID_GROUP = '(?P<id>.+?)'
+
 # Statuses that indicate a job is completed, successfully or not
-JOB_FINAL_STATUSES = ["FINISHED", "FAILED"]
+JOB_FINISHED = "FINISHED"
+JOB_FINAL_STATUSES = [JOB_FINISHED, "FAILED"]
+
+# Seconds before the first check of the status of an Opencast job. The wait doubles after every
+# check, up to JOB_MAX_WAIT
+JOB_FIRST_WAIT = 0.25
+
+# Maximum number of seconds between two checks of the status of an Opencast job
+JOB_MAX_WAIT = 5
+
+# Seconds after which an Opencast job that has not finished is no longer waited for
+JOB_TIMEOUT = 50
 
-# Maximum number of attempts to check the status of an Opencast job
-MAX_ATTEMPTS = 10
+# Seconds to wait for the server to answer a request for the status of a job
+JOB_REQUEST_TIMEOUT = 30
 
-# Seconds between attempts to check the statos of an Opencast job
-WAIT_TIME = 5
+# Maximum number of MPs whose unpublish job may be waited for at the same time
+MAX_PENDING_JOBS = 100
 
 # Job endpoint
 JOB_ENDPOINT = 'services/job/{0}.xml'
@@ -89,11 +145,20 @@ XML_OP_TAG = '{{{}}}operation'.format(JOB_NAMESPACE)
 XML_ID_ATTR = 'id'
 # XML attribute containing the total number of results in a workflow query
 XML_WF_TOTAL_ATTR = 'totalCount'
+# XML attribute containing the total number of results in a search or archive query
+XML_TOTAL_ATTR = 'total'
 # XML attribute containing a job's current status
 XML_JOB_STATUS_ATTR = 'status'
 
 # Name of the query parameter to specify an identifier
 QUERY_ID = "id"
+# Name of the query parameter to specify a series identifier to the search service
+QUERY_SEARCH_SERIES = "sid"
+# Name of the query parameter to specify a series identifier to the archive service
+QUERY_ARCH_SERIES = "series"
+# Names of the query parameters to specify a page size and offset to the search and archive services
+QUERY_LIMIT = "limit"
+QUERY_OFFSET = "offset"
 # Name of the query paramenter to specify a MP identifier to the workflow service
 QUERY_WF_MP = 'mp'
 # Name of the query parameter to specify a page size to the workflow service
@@ -103,8 +168,33 @@ QUERY_WF_PAGE_OFFSET = 'startPage'
 # Name of the query parameter to compress results provided by the workflow service
 QUERY_WF_COMPACT = 'compact'
 
-DEFAULT_PAGE_SIZE = 50
+# Number of workflows listed per request. The workflows of a MP are all listed before any of them
+# is deleted, so large pages save requests
+DEFAULT_PAGE_SIZE = 500
 
+# Page size used to list all the MPs in the search and archive services in a dry run
+PRECHECK_PAGE_SIZE = 500
+
+# Seconds to wait for the server to answer each page of that list
+PRECHECK_REQUEST_TIMEOUT = 120
+
+# Default number of mediapackages deleted concurrently
+DEFAULT_JOBS = 1
+
+# Seconds between two checks of the workers' state by the main thread
+POOL_POLL_INTERVAL = 0.1
+
+# Lock to keep the lines printed by concurrent deletions from mixing with each other
+OUTPUT_LOCK = threading.Lock()
+_print = print
+
+
+def print(*args, **kwargs):
+    """
+    Print function safe to call from several threads: every call is written as a whole
+    """
+    with OUTPUT_LOCK:
+        _print(*args, **kwargs)
 
 
 class OpencastDigestAuth(HTTPDigestAuth):
@@ -140,53 +230,161 @@ def normalize_url(url):
         return urlparse.urlunparse(urlparse.urlparse("//" + url, 'http'))
 
 
-def wait_for_job(job_id, server_url, auth, mp_id=None):
-    """
-    Waits while an asynchronous job completes and reports its state
+class JobTracker(object):
     """
-    if job_id < 0:
-        return
-
-    if mp_id:
-        prefix = "[{}] ".format(mp_id)
-    else:
-        prefix = ""
+    Wait for any number of asynchronous Opencast jobs at once.
 
-    # Check when the job finishes
-    for dummy in range(MAX_ATTEMPTS):
-        # Give the job some time to finish
-        time.sleep(WAIT_TIME)
+    A background thread checks the status of every tracked job, starting after JOB_FIRST_WAIT
+    seconds and doubling the wait after every check, up to JOB_MAX_WAIT seconds. Once a job
+    reaches one of the JOB_FINAL_STATUSES, or JOB_TIMEOUT seconds have passed, its outcome is
+    reported and its callback is called, from the tracker's thread. Callbacks should therefore
+    return quickly, for instance by queueing the rest of the work somewhere else.
+    """
 
-        # Check the status
-        resp = requests.get(
-            urlparse.urljoin(server_url, JOB_ENDPOINT.format(job_id)),
-            auth=auth
-        )
+    def __init__(self, server_url, auth):
+        self.job_url = urlparse.urljoin(server_url, JOB_ENDPOINT)
+        self.auth = auth
+        # Job ID --> [time of the next check, current wait, deadline, MP ID, callback, last status]
+        self.jobs = dict()
+        self.condition = threading.Condition()
+
+        thread = threading.Thread(target=self.run, name="job-tracker")
+        thread.daemon = True
+        thread.start()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.jobs)
+
+    def track(self, job_id, mp_id, callback):
+        """
+        Start waiting for a job. When the wait is over, the callback is called with the final
+        status of the job, or None if it timed out
+        """
+        now = time.time()
+        with self.condition:
+            self.jobs[job_id] = [
+                now + JOB_FIRST_WAIT, JOB_FIRST_WAIT, now + JOB_TIMEOUT, mp_id, callback, None]
+            self.condition.notify()
+
+    def run(self):
+        """
+        Check the jobs as they are due
+        """
+        while True:
+            with self.condition:
+                now = time.time()
+                due = [(job_id, job[3]) for job_id, job in self.jobs.iteritems() if job[0] <= now]
+                if not due:
+                    if self.jobs:
+                        self.condition.wait(min(job[0] for job in self.jobs.itervalues()) - now)
+                    else:
+                        self.condition.wait()
+                    continue
 
-        if resp.status_code == 200:
+            for job_id, mp_id in due:
+                try:
+                    self.check(job_id)
+                except Exception as exc:
+                    # Never let an unexpected error stop the tracker: give up on the job instead,
+                    # unless it was finished already and the error came from its callback
+                    print("[{}] ERROR ({}) while waiting for job {}: {}".format(
+                        mp_id, type(exc).__name__, job_id, exc), file=sys.stderr)
+                    with self.condition:
+                        pending = self.jobs.get(job_id) is not None
+                    if pending:
+                        self.finish(job_id, None)
+
+    def check(self, job_id):
+        """
+        Check the status of a job once, and either schedule the next check or finish waiting for it
+        """
+        with self.condition:
+            job = self.jobs[job_id]
+        dummy, wait, deadline, mp_id, callback, job_status = job
+
+        operation = None
+        try:
+            resp = requests.get(self.job_url.format(job_id), auth=self.auth,
+                                timeout=JOB_REQUEST_TIMEOUT)
+        except RequestException:
+            # Connection errors and timeouts may be transient. Try again in the next check
+            resp = None
+        if resp is not None and resp.status_code == 200:
             job_xml = etree.fromstring(resp.content)
             job_status = job_xml.get(XML_JOB_STATUS_ATTR)
-            if job_status in JOB_FINAL_STATUSES:
-                print(
-                    "{}'{}' operation finished with status: {}".format(
-                        prefix,
-                        job_xml.find(XML_OP_TAG).text,
-                        job_status
-                    )
-                )
-                break
-    else:
-        if job_status:
-            add = ". Last known status is {}".format(job_status)
+            operation = job_xml.findtext(XML_OP_TAG)
+
+        if job_status in JOB_FINAL_STATUSES:
+            print("[{}] '{}' operation finished with status: {}".format(
+                mp_id, operation, job_status))
+        elif time.time() >= deadline:
+            if job_status:
+                add = ". Last known status is {}".format(job_status)
+            else:
+                add = ""
+            print("[{}] Timed out waiting for job {} to finish{}".format(mp_id, job_id, add))
+            job_status = None
         else:
-            add = ""
-        print("{}Timed out waiting for job {} to finish{}".format(prefix, job_id, add))
+            wait = min(wait * 2, JOB_MAX_WAIT)
+            with self.condition:
+                job[:] = [time.time() + wait, wait, deadline, mp_id, callback, job_status]
+            return
 
+        self.finish(job_id, job_status)
 
-def unpublish(mp_id, server_url, auth, dry_run):
+    def finish(self, job_id, job_status):
+        """
+        Stop waiting for a job and call its callback with the given status
+        """
+        with self.condition:
+            callback = self.jobs.pop(job_id)[4]
+        callback(job_status)
+
+
+def list_mp_ids(server_url, endpoint, series_param, series_ids, auth):
+    """
+    Page through all the MPs listed by a search or archive endpoint, optionally only those in the
+    given series, and count how many times each MP ID appears
+    """
+    url = urlparse.urljoin(server_url, endpoint)
+    mp_ids = Counter()
+    for series_id in series_ids or [None]:
+        query_params = {QUERY_LIMIT: PRECHECK_PAGE_SIZE, QUERY_OFFSET: 0}
+        if series_id:
+            query_params[series_param] = series_id
+        while True:
+            resp = requests.get(url, params=query_params, auth=auth, timeout=PRECHECK_REQUEST_TIMEOUT)
+            resp.raise_for_status()
+            root = etree.fromstring(resp.content)
+            results = root.findall('.//'+XML_MP_TAG)
+            mp_ids.update(result.get(XML_ID_ATTR) for result in results)
+            query_params[QUERY_OFFSET] += len(results)
+            # The server may return fewer results than requested, so rely on the total when it is known
+            total = root.get(XML_TOTAL_ATTR)
+            if not results or (total is not None and query_params[QUERY_OFFSET] >= int(total)) or \
+               (total is None and len(results) < PRECHECK_PAGE_SIZE):
+                break
+    return mp_ids
+
+
+def unpublish(mp_id, server_url, auth, limiter, dry_run, published=None):
     """
-    Delete publications of the given mediapackage
+    Delete publications of the given mediapackage.
+
+    Return the ID of the job retracting the publications, -1 if there is no job to wait for, or
+    None if the publications could not be deleted.
+    In a dry run, the publication is looked up in the published MP IDs, if provided, instead of
+    querying the server
     """
+    if dry_run and published is not None:
+        if mp_id in published:
+            print("[{}] Would unpublish from search index at {}".format(
+                mp_id, urlparse.urljoin(server_url, SEARCH_GET_ENDPOINT)))
+        else:
+            print("[{}] Would NOT unpublish from search index at {}: no publication found".format(
+                mp_id, urlparse.urljoin(server_url, SEARCH_GET_ENDPOINT)))
+        return -1
 
     try:
         if dry_run:
@@ -222,7 +420,8 @@ def unpublish(mp_id, server_url, auth, dry_run):
                     )
                 )
         else:
-            resp = requests.delete(
+            resp = limiter.call(
+                requests.delete,
                 urlparse.urljoin(server_url, SEARCH_DELETE_ENDPOINT).format(mp_id),
                 auth=auth
             )
@@ -230,18 +429,312 @@ def unpublish(mp_id, server_url, auth, dry_run):
 
             if resp.status_code == 200:
                 return int(etree.fromstring(resp.content).get(XML_ID_ATTR))
+            elif resp.status_code != 404:
+                # A 404 means that the MP is not published
+                return None
 
     except ConnectionError as conn_e:
         print("\nCould not connect to '{0}'.".format(conn_e.request.url), file=sys.stderr)
         print("Please make sure you provided the correct URL and that you are "
               "connected to the internet.", file=sys.stderr, end="\n\n")
+        return None
 
     return -1
 
 
-def retract(mp_id, mountpoint, dry_run):
+class TrashPurger(object):
+    """
+    Move directories to a trash directory in the same filesystem, which is instant, and delete them
+    from there in a few background threads.
+
+    The trash of each filesystem is in its highest directory up to the mountpoint, and the
+    directories keep their path, relative to that one, inside the trash. If the path is taken
+    already, a suffix '.~N~' is added to it. The directories left in the trash by a previous,
+    interrupted run are purged too. Between batches of PURGE_BATCH_SIZE deleted files, the purging
+    threads pause for PURGE_PAUSE seconds.
+    """
+
+    def __init__(self, mountpoint, jobs):
+        self.mountpoint = os.path.abspath(mountpoint)
+        # Highest directory in the same filesystem as each directory whose contents are moved
+        self.tops = {}
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        for subdir in DISTRIBUTION_DIRS:
+            self.queue_leftovers(os.path.join(self.mountpoint, subdir))
+        for i in range(jobs):
+            thread = threading.Thread(target=self.run, name="purge-{}".format(i))
+            thread.daemon = True
+            thread.start()
+
+    def get_trash_path(self, directory):
+        """
+        Return the path inside the trash where the contents of a directory are moved
+        """
+        directory = os.path.abspath(directory)
+        with self.lock:
+            top = self.tops.get(directory)
+            if top is None:
+                device = os.stat(directory).st_dev
+                top = directory
+                while top != self.mountpoint and os.stat(os.path.dirname(top)).st_dev == device:
+                    top = os.path.dirname(top)
+                self.tops[directory] = top
+        return os.path.normpath(os.path.join(top, TRASH_DIR, os.path.relpath(directory, top)))
+
+    def queue_leftovers(self, directory):
+        """
+        Queue the contents of a directory which are still in the trash to be purged
+        """
+        if not os.path.isdir(directory):
+            return
+        trash_dir = self.get_trash_path(directory)
+        try:
+            names = os.listdir(trash_dir)
+        except OSError as ose:
+            if ose.errno != errno.ENOENT:
+                raise
+            return
+        for name in names:
+            self.queue.put((TRASH_SUFFIX_REGEXP.sub('', name), os.path.join(trash_dir, name)))
+
+    def move(self, mp_id, path):
+        """
+        Move a directory into the trash and queue it to be purged.
+
+        If the directory cannot be moved to a different filesystem, it is deleted right away instead
+        """
+        trash_path = os.path.join(self.get_trash_path(os.path.dirname(path)), os.path.basename(path))
+        candidate = trash_path
+        i = 0
+        while os.path.lexists(candidate):
+            i += 1
+            candidate = "{}.~{}~".format(trash_path, i)
+
+        try:
+            os.makedirs(os.path.dirname(candidate))
+        except OSError as ose:
+            if ose.errno != errno.EEXIST:
+                raise
+
+        try:
+            os.rename(path, candidate)
+        except OSError as ose:
+            if ose.errno != errno.EXDEV:
+                raise
+            shutil.rmtree(path)
+            print("[{}] Deleted distribution directory: '{}'".format(mp_id, path))
+        else:
+            print("[{}] Moved distribution directory to the trash: '{}'".format(mp_id, path))
+            self.queue.put((mp_id, candidate))
+
+    def run(self):
+        """
+        Purge the directories moved to the trash, as they come
+        """
+        while True:
+            mp_id, path = self.queue.get()
+            try:
+                self.purge(path)
+                print("[{}] Purged '{}' from the trash".format(mp_id, path))
+            except OSError as ose:
+                print("[{}] ERROR: could not purge '{}' from the trash: {}".format(
+                    mp_id, path, ose), file=sys.stderr)
+            finally:
+                self.queue.task_done()
+
+    @staticmethod
+    def purge(path):
+        """
+        Delete a directory tree gently, pausing after every batch of files
+        """
+        deleted = 0
+        for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+            for filename in filenames:
+                os.remove(os.path.join(dirpath, filename))
+                deleted += 1
+                if deleted % PURGE_BATCH_SIZE == 0:
+                    time.sleep(PURGE_PAUSE)
+            for dirname in dirnames:
+                dirname = os.path.join(dirpath, dirname)
+                if os.path.islink(dirname):
+                    os.remove(dirname)
+                else:
+                    os.rmdir(dirname)
+        os.rmdir(path)
+
+    def wait(self):
+        """
+        Wait until every directory in the trash is purged
+        """
+        # Joining the queue would block the keyboard interrupts in Python 2
+        while self.queue.unfinished_tasks:
+            time.sleep(POOL_POLL_INTERVAL)
+
+
+class Journal(object):
+    """
+    Record the outcome of every deletion step of every MP in a SQLite database, so that an
+    interrupted batch can be resumed without repeating the steps already completed.
+
+    Every outcome is committed as soon as it is recorded. A read-only journal reports the recorded
+    outcomes, but does not record new ones. It must exist already, and it is never modified
+    """
+
+    def __init__(self, path, read_only=False):
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        if read_only:
+            # sqlite3 in Python 2 cannot open a database in read-only mode, and connecting creates
+            # the file, so check it first
+            if not os.path.isfile(path):
+                raise IOError(errno.ENOENT, "The journal '{}' does not exist".format(path))
+        # The connection is shared by all the threads, but only used while holding the lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        if read_only:
+            try:
+                table = self.connection.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'steps'").fetchone()
+            except sqlite3.DatabaseError:
+                table = None
+            if table is None:
+                self.connection.close()
+                raise IOError(errno.EINVAL, "'{}' is not a journal".format(path))
+            return
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS steps ("
+                "mp_id TEXT NOT NULL, step TEXT NOT NULL, status TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL, updated TEXT NOT NULL, PRIMARY KEY (mp_id, step))")
+
+    def is_done(self, mp_id, step):
+        """
+        Check whether a step of a MP was completed already
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT status FROM steps WHERE mp_id = ? AND step = ?", (mp_id, step)).fetchone()
+        return row is not None and row[0] == STEP_DONE
+
+    def record(self, mp_id, step, success):
+        """
+        Record the outcome of an attempt to perform a step of a MP
+        """
+        if self.read_only:
+            return
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO steps VALUES (?, ?, ?, "
+                "COALESCE((SELECT attempts FROM steps WHERE mp_id = ? AND step = ?), 0) + 1, "
+                "datetime('now'))",
+                (mp_id, step, STEP_DONE if success else STEP_FAILED, mp_id, step))
+
+    def report(self, mp_ids):
+        """
+        Print a summary of the recorded outcomes of the given MPs
+        """
+        step_counts = dict((step, {STEP_DONE: 0, STEP_FAILED: 0}) for step in STEPS)
+        completed = []
+        failed = []
+        pending = []
+        for mp_id in mp_ids:
+            with self.lock:
+                statuses = dict(self.connection.execute(
+                    "SELECT step, status FROM steps WHERE mp_id = ?", (mp_id,)).fetchall())
+            for step, status in statuses.iteritems():
+                if step in step_counts:
+                    step_counts[step][status] += 1
+            if all(statuses.get(step) == STEP_DONE for step in STEPS):
+                completed.append(mp_id)
+            elif STEP_FAILED in statuses.values():
+                failed.append(mp_id)
+            else:
+                pending.append(mp_id)
+
+        print("{:<12}{:>10}{:>10}".format("Step", "Done", "Failed"))
+        for step in STEPS:
+            print("{:<12}{:>10}{:>10}".format(
+                step, step_counts[step][STEP_DONE], step_counts[step][STEP_FAILED]))
+        print()
+        print("MPs completely deleted: {}".format(len(completed)))
+        print("MPs with failed steps: {}".format(len(failed)))
+        for mp_id in failed:
+            print("    {}".format(mp_id))
+        print("MPs with steps not attempted yet: {}".format(len(pending)))
+
+
+def skip_step(journal, mp_id, step):
+    """
+    Check whether a deletion step of a MP can be skipped because the journal, if any, says it was
+    completed already
+    """
+    if journal and journal.is_done(mp_id, step):
+        print("[{}] Skipping step '{}': already completed according to the journal".format(
+            mp_id, step))
+        return True
+    return False
+
+
+def run_step(journal, mp_id, step, function, *args):
+    """
+    Perform a deletion step of a MP, unless the journal says it was completed already, and record
+    its outcome in the journal, if any. Steps succeed when the function does not return False
+    """
+    if skip_step(journal, mp_id, step):
+        return
+
+    try:
+        success = function(*args) is not False
+    except Exception:
+        if journal:
+            journal.record(mp_id, step, False)
+        raise
+    if journal:
+        journal.record(mp_id, step, success)
+
+
+def list_dir(path):
+    """
+    Iterate over the names of the entries in a directory, without reading the whole list first when
+    possible. A directory that does not exist has no entries
+    """
+    try:
+        if scandir:
+            return (entry.name for entry in scandir(path))
+        return iter(os.listdir(path))
+    except OSError as ose:
+        if ose.errno not in [errno.ENOENT, errno.ENOTDIR]:
+            raise
+        return iter([])
+
+
+def index_distribution_files(mountpoint):
+    """
+    Read the directories in DISTRIBUTION_FILES once and index the files in them matching the
+    corresponding regexp by the MP ID they contain.
+
+    The result maps each directory (relative to the mountpoint) to a dictionary of MP IDs and the
+    list of the files for each MP in that directory
+    """
+    file_index = dict()
+    for parent, regexp in DISTRIBUTION_FILES:
+        matcher = re.compile(regexp.format(id=DISTRIBUTION_ID_GROUP))
+        files = file_index.setdefault(parent, dict())
+        for filename in list_dir(os.path.join(mountpoint, parent)):
+            match = matcher.match(filename)
+            if match:
+                files.setdefault(match.group('id'), []).append(filename)
+    return file_index
+
+
+def retract(mp_id, mountpoint, dry_run, file_index=None, trash=None):
     """
-    Retract distribution files from known locations
+    Retract distribution files from known locations.
+
+    If an index of the distribution files, as returned by index_distribution_files, is provided,
+    the files are looked up there instead of listing their directories.
+    If a TrashPurger is provided, the distribution directories are moved into its trash instead of
+    being deleted
     """
 
     for subdir in DISTRIBUTION_DIRS:
@@ -249,6 +742,9 @@ def retract(mp_id, mountpoint, dry_run):
         if dry_run:
             if os.path.isdir(fulldir) and not os.path.islink(fulldir):
                 print("[{}] Would delete distribution directory: '{}'".format(mp_id, fulldir))
+        elif trash:
+            if os.path.isdir(fulldir) and not os.path.islink(fulldir):
+                trash.move(mp_id, fulldir)
         else:
             try:
                 shutil.rmtree(fulldir)
@@ -261,36 +757,35 @@ def retract(mp_id, mountpoint, dry_run):
 
     for parent, regexp in DISTRIBUTION_FILES:
         fullparent = os.path.join(mountpoint, parent, '')
-        matcher = re.compile(regexp.format(id=mp_id))
-        files = []
-        try:
-            files = os.listdir(fullparent)
-        except OSError as ose:
-            if ose.errno not in [errno.ENOENT, errno.ENOTDIR]:
-                raise
+        if file_index is None:
+            matcher = re.compile(regexp.format(id=mp_id))
+            files = [filename for filename in list_dir(fullparent) if matcher.match(filename)]
+        else:
+            files = file_index[parent].pop(mp_id, [])
 
         for filename in files:
-            if matcher.match(filename):
-                fullpath = urlparse.urljoin(fullparent, filename)
-                if dry_run:
-                    if os.path.isfile(fullpath):
-                        print("[{}] Would delete file '{}'".format(mp_id, fullpath))
-                else:
-                    try:
-                        os.remove(fullpath)
-                        print("[{}] Removed distribution file: {}".format(mp_id, fullpath))
-                    except OSError as ose:
-                        if ose.errno != errno.EISDIR:
-                            raise
+            fullpath = urlparse.urljoin(fullparent, filename)
+            if dry_run:
+                if os.path.isfile(fullpath):
+                    print("[{}] Would delete file '{}'".format(mp_id, fullpath))
+            else:
+                try:
+                    os.remove(fullpath)
+                    print("[{}] Removed distribution file: {}".format(mp_id, fullpath))
+                except OSError as ose:
+                    if ose.errno not in [errno.EISDIR, errno.ENOENT]:
+                        raise
 
 
-def delete_workflows(mp_id, server_url, auth, dry_run):
+def list_workflows(mp_id, server_url, session):
     """
-    Delete the workflows corresponding to a certain MP id at the provided server
+    Get the IDs of all the workflows corresponding to a certain MP id at the provided server.
+
+    The whole list is read before deleting anything, because each deletion shifts the pages that
+    follow. Return None if the workflows could not be listed
     """
 
     wf_get_url = urlparse.urljoin(server_url, WF_GET_ENDPOINT)
-    wf_delete_url = urlparse.urljoin(server_url, WF_DELETE_ENDPOINT)
 
     # Get the query parameters for the WF requests ready
     query_params = dict()
@@ -299,63 +794,101 @@ def delete_workflows(mp_id, server_url, auth, dry_run):
     query_params[QUERY_WF_PAGE_SIZE] = DEFAULT_PAGE_SIZE
     query_params[QUERY_WF_MP] = mp_id
 
-    i = 0
+    wf_ids = []
     n_workflows = -1
+    while (n_workflows < 0) or (len(wf_ids) < n_workflows):
+        resp = session.get(wf_get_url, params=query_params)
+        if resp.status_code != 200:
+            print(
+                ("Received unexpected HTTP {0} status while reading the workflow list. "
+                 "Please check your network, and that the arguments provided are correct")
+                .format(resp.status_code),
+                file=sys.stderr)
+            return None
+
+        workflows = etree.fromstring(resp.content)
+        n_workflows = int(workflows.get(XML_WF_TOTAL_ATTR))
+        page = [workflow.get(XML_ID_ATTR) for workflow in workflows.findall('.//'+XML_WF_TAG)]
+        if not page:
+            # The total changed while reading the list
+            break
+        wf_ids.extend(page)
+        query_params[QUERY_WF_PAGE_OFFSET] += 1
+
+    return wf_ids
+
+
+def delete_workflows(mp_id, server_url, session, limiter, dry_run):
+    """
+    Delete the workflows corresponding to a certain MP id at the provided server.
+
+    The workflows are listed first, and then deleted concurrently through the session, as fast as
+    the limiter allows. Return False if the workflows could not be listed or any of them could not
+    be deleted
+    """
+
+    wf_delete_url = urlparse.urljoin(server_url, WF_DELETE_ENDPOINT)
+
     try:
-        while (n_workflows < 0) or (i < n_workflows):
-            resp = requests.get(wf_get_url, params=query_params, auth=auth)
-            if resp.status_code != 200:
-                print(
-                    ("Received unexpected HTTP {0} status while reading the workflow list. "
-                     "Please check your network, and that the arguments provided are correct")
-                    .format(resp.status_code),
-                    file=sys.stderr)
-                return
-
-            if n_workflows < 0:
-                # Set the maximum number of workflows and then convert the results into a list
-                workflows = etree.fromstring(resp.content)
-                n_workflows = int(workflows.get(XML_WF_TOTAL_ATTR))
-                workflows = workflows.findall('.//'+XML_WF_TAG)
-            else:
-                # Simply convert the results in an list of XML trees
-                workflows = etree.fromstring(resp.content).findall('.//'+XML_WF_TAG)
+        wf_ids = list_workflows(mp_id, server_url, session)
+        if wf_ids is None:
+            return False
 
-            for workflow in workflows:
-                if dry_run:
-                    print(
-                        "[{}] Would delete workflow with ID {}".format(
-                            mp_id,
-                            workflow.get(XML_ID_ATTR)
-                        )
-                    )
-                else:
-                    resp = requests.delete(
-                        wf_delete_url.format(workflow.get(XML_ID_ATTR)),
-                        auth=auth
-                    )
-                    print(
-                        "[{}] Deleting workflow '{}' returned HTTP status {}".format(
-                            mp_id,
-                            workflow.get(XML_ID_ATTR),
-                            resp.status_code
-                        )
-                    )
+        if dry_run:
+            for wf_id in wf_ids:
+                print("[{}] Would delete workflow with ID {}".format(mp_id, wf_id))
+            return True
 
-            query_params[QUERY_WF_PAGE_OFFSET] += 1
-            i += len(workflows)
+        responses = oc_limiter.map_limited(
+            limiter, lambda wf_id: session.delete(wf_delete_url.format(wf_id)), wf_ids)
     except ConnectionError as conn_e:
         print("\nCould not connect to '{0}'.".format(conn_e.request.url), file=sys.stderr)
         print(
             "Please make sure you provided the correct URL and that you are "
             "connected to the internet.", file=sys.stderr, end="\n\n")
-        return
+        return False
+
+    success = True
+    for wf_id, resp in zip(wf_ids, responses):
+        print("[{}] Deleting workflow '{}' returned HTTP status {}".format(
+            mp_id, wf_id, resp.status_code))
+        # A 404 means that the workflow is gone already
+        success = success and (resp.ok or resp.status_code == 404)
 
+    return success
 
-def unarchive(mp_id, server_url, auth, dry_run, legacy):
+
+def make_session(auth, pool_size):
+    """
+    Create a session keeping a pool of connections to each server, large enough for the given
+    number of concurrent requests
+    """
+    session = requests.Session()
+    session.auth = auth
+    adapter = HTTPAdapter(pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def unarchive(mp_id, server_url, auth, limiter, dry_run, legacy, archived=None):
     """
-    Delete archive of the given mediapackage
+    Delete archive of the given mediapackage.
+
+    Return False if the archive could not be deleted.
+    In a dry run, the archive entries are looked up in the counts of archived MP IDs, if provided,
+    instead of querying the server
     """
+    if dry_run and archived is not None:
+        url = urlparse.urljoin(server_url, ARCH_GET_ENDPOINT)
+        if archived[mp_id] > 1:
+            print("[{}] WARNING: {} archive entries were found for the mediapackage!".format(
+                mp_id, archived[mp_id]))
+        if archived[mp_id]:
+            print("[{}] Would unarchive MP at URL {}".format(mp_id, url))
+        else:
+            print("[{}] Would NOT unarchive MP at URL {}: no archive found".format(mp_id, url))
+        return
 
     try:
         resp = requests.get(
@@ -392,17 +925,21 @@ def unarchive(mp_id, server_url, auth, dry_run, legacy):
                     )
             else:
                 if legacy:
-                    resp = requests.delete(
+                    resp = limiter.call(
+                        requests.delete,
                         urlparse.urljoin(server_url, LEGACY_ARCH_DELETE_ENDPOINT).format(mp_id),
                         auth=auth
                     )
                 else:
-                    resp = requests.delete(
+                    resp = limiter.call(
+                        requests.delete,
                         urlparse.urljoin(server_url, ARCH_DELETE_ENDPOINT).format(mp_id),
                         auth=auth
                     )
                 print("[{}] Unarchiving MP at {} returned HTTP status {}".format(
                     mp_id, resp.request.url, resp.status_code))
+                # A 404 means that the MP is not archived
+                return resp.ok or resp.status_code == 404
         else:
             print(
                 "[{}] Not sure if MP is archived at {}: server returned unexpected HTTP {}".format(
@@ -411,11 +948,161 @@ def unarchive(mp_id, server_url, auth, dry_run, legacy):
                     resp.status_code
                 )
             )
+            return False
     except ConnectionError as conn_e:
         print("\nCould not connect to '{0}'.".format(conn_e.request.url), file=sys.stderr)
         print("Please make sure you provided the correct URL and that you are "
               "connected to the internet.", file=sys.stderr, end="\n\n")
-        return
+        return False
+
+
+def finish_deletion(mp_id, admin_url, auth, session, limiter, args,
+                    file_index=None, trash=None, journal=None, archived=None):
+    """
+    Run the deletion steps that follow the unpublication of a MP, in order
+    """
+    run_step(journal, mp_id, STEP_RETRACT,
+             retract, mp_id, args.mountpoint, args.not_really, file_index, trash)
+    run_step(journal, mp_id, STEP_WORKFLOWS,
+             delete_workflows, mp_id, admin_url, session, limiter, args.not_really)
+    run_step(journal, mp_id, STEP_ARCHIVE,
+             unarchive, mp_id, admin_url, auth, limiter, args.not_really, args.legacy, archived)
+
+
+def read_ids(filename):
+    """
+    Read the MP IDs in a file containing one ID per line
+    """
+    with open(filename, 'r') as inputfile:
+        for line in inputfile:
+            # Remove whitespace and ignore everything after the first inner whitespace
+            fields = line.split()
+            if not fields or fields[0][0] == '#':
+                # Ignore empty lines and comments
+                continue
+            yield fields[0]
+
+
+def delete_mps(mp_ids, search_url, admin_url, auth, args,
+               file_index=None, trash=None, journal=None, published=None, archived=None):
+    """
+    Delete several MPs in a pool of worker threads.
+
+    Each MP is first unpublished. The rest of its steps are queued once its unpublish job finishes,
+    which a JobTracker waits for in the background, so that the workers can start with other MPs
+    in the meantime. Queued MPs take precedence over new ones, and no new MPs are started while
+    MAX_PENDING_JOBS jobs are being waited for.
+
+    The distribution files are looked up in file_index, if provided (see index_distribution_files),
+    and the distribution directories are moved to the trash, if provided (see TrashPurger).
+    The outcome of the steps is recorded in the journal, if provided, and the steps it reports as
+    completed are skipped. In a dry run, the MPs are looked up in the published and archived MP IDs,
+    if provided (see list_mp_ids).
+
+    The requests deleting contents from the servers are limited by an adaptive limiter, whose final
+    state is reported at the end
+    """
+    tracker = JobTracker(admin_url, auth)
+    limiter = oc_limiter.from_args(args)
+    session = make_session(auth, args.max_concurrency)
+    # MPs whose unpublish job is over, with the job's final status
+    unpublished = Queue.Queue()
+    mp_ids = iter(mp_ids)
+    lock = threading.Lock()
+    # Number of MPs started but not completely deleted yet, and whether there are any more MPs
+    state = {'running': 0, 'exhausted': False}
+
+    def next_mp():
+        with lock:
+            if state['exhausted'] or len(tracker) >= MAX_PENDING_JOBS:
+                return None
+            mp_id = next(mp_ids, None)
+            if mp_id is None:
+                state['exhausted'] = True
+            else:
+                state['running'] += 1
+            return mp_id
+
+    def start(mp_id):
+        if skip_step(journal, mp_id, STEP_UNPUBLISH):
+            finish(mp_id)
+            return
+
+        try:
+            job_id = unpublish(mp_id, search_url, auth, limiter, args.not_really, published)
+        except Exception as exc:
+            print("[{}] ERROR ({}): {}".format(mp_id, type(exc).__name__, exc), file=sys.stderr)
+            job_id = None
+        if job_id is None or job_id < 0:
+            if journal:
+                journal.record(mp_id, STEP_UNPUBLISH, job_id is not None)
+            finish(mp_id)
+        else:
+            tracker.track(job_id, mp_id, lambda job_status: unpublished.put((mp_id, job_status)))
+
+    def finish_unpublished(item):
+        mp_id, job_status = item
+        if journal:
+            journal.record(mp_id, STEP_UNPUBLISH, job_status == JOB_FINISHED)
+        finish(mp_id)
+
+    def finish(mp_id):
+        try:
+            finish_deletion(mp_id, admin_url, auth, session, limiter, args,
+                            file_index, trash, journal, archived)
+        except Exception as exc:
+            # Do not let one MP stop the deletion of the others
+            print("[{}] ERROR ({}): {}".format(mp_id, type(exc).__name__, exc), file=sys.stderr)
+        finally:
+            with lock:
+                state['running'] -= 1
+
+    def work():
+        while True:
+            try:
+                finish_unpublished(unpublished.get_nowait())
+                continue
+            except Queue.Empty:
+                pass
+
+            mp_id = next_mp()
+            if mp_id is not None:
+                start(mp_id)
+                continue
+
+            with lock:
+                if state['exhausted'] and not state['running']:
+                    return
+            try:
+                finish_unpublished(unpublished.get(timeout=POOL_POLL_INTERVAL))
+            except Queue.Empty:
+                pass
+
+    workers = [threading.Thread(target=work, name="delete-{}".format(i)) for i in range(args.jobs)]
+    for worker in workers:
+        # Do not let the workers keep the script alive after an interruption
+        worker.daemon = True
+        worker.start()
+
+    # Joining without a timeout would block the keyboard interrupts in Python 2
+    while any(worker.is_alive() for worker in workers):
+        time.sleep(POOL_POLL_INTERVAL)
+
+    if not args.not_really:
+        print(limiter.summary())
+
+
+def positive_int(value):
+    """
+    Parse a strictly positive integer argument, such as the number of concurrent deletions
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("'{0}' is not an integer".format(value))
+    if number < 1:
+        raise argparse.ArgumentTypeError("'{0}' is not a positive number".format(value))
+    return number
 
 
 def delete_mp(args):
@@ -430,6 +1117,26 @@ def delete_mp(args):
         - Delete the MP from the archive
     """
 
+    journal = None
+    if args.journal:
+        if args.not_really and not args.report and not os.path.exists(args.journal):
+            # A dry run before the first real one: there is nothing recorded yet
+            print("The journal '{}' does not exist yet. No steps are recorded as done".format(
+                args.journal))
+        else:
+            try:
+                journal = Journal(args.journal, read_only=args.not_really or args.report)
+            except IOError as ioe:
+                print("ERROR: {}".format(ioe.strerror), file=sys.stderr)
+                return 1
+
+    if args.report:
+        if args.mediapackage_id[0] == '@':
+            journal.report(read_ids(args.mediapackage_id[1:]))
+        else:
+            journal.report([args.mediapackage_id])
+        return
+
     # Process server URLs
     admin_url = normalize_url(args.admin_url)
 
@@ -446,30 +1153,39 @@ def delete_mp(args):
     # Set authentication mechanism
     auth = OpencastDigestAuth(args.digest_user, args.digest_pass)
 
+    if args.trash and not args.not_really:
+        trash = TrashPurger(args.mountpoint, args.purge_jobs)
+    else:
+        trash = None
+
     if args.mediapackage_id[0] == '@':
-        # Asume the ID is a file containing one ID per line
-        with open(args.mediapackage_id[1:], 'r') as inputfile:
-            for mp_id in inputfile.readlines():
-                # Remove whitespace and ignore everything after the first inner whitespace
-                mp_id = mp_id.strip().split()[0]
-                if mp_id[0] == '#':
-                    # Ignore comments
-                    continue
+        # Asume the ID is a file containing one ID per line.
+        # The directories with distribution files are read only once for all the MPs
+        file_index = index_distribution_files(args.mountpoint)
+
+        if args.not_really:
+            # Check which MPs exist with a few large queries, rather than a few for each MP
+            try:
+                published = list_mp_ids(
+                    search_url, SEARCH_GET_ENDPOINT, QUERY_SEARCH_SERIES, args.series, auth)
+                archived = list_mp_ids(
+                    admin_url, ARCH_GET_ENDPOINT, QUERY_ARCH_SERIES, args.series, auth)
+            except (ConnectionError, requests.HTTPError) as exc:
+                print("Could not list the published and archived MPs: {}".format(exc),
+                      file=sys.stderr)
+                return 1
+            print("Found {} published and {} archived MPs".format(len(published), len(archived)))
+        else:
+            published = archived = None
 
-                # Wait for the unpublish job to finish
-                wait_for_job(
-                    unpublish(mp_id, search_url, auth, args.not_really),
-                    args.admin_url, auth, mp_id)
-                retract(mp_id, args.mountpoint, args.not_really)
-                delete_workflows(mp_id, admin_url, auth, args.not_really)
-                unarchive(mp_id, admin_url, auth, args.not_really, args.legacy)
+        delete_mps(read_ids(args.mediapackage_id[1:]), search_url, admin_url, auth, args,
+                   file_index, trash, journal, published, archived)
     else:
-        wait_for_job(
-            unpublish(args.mediapackage_id, search_url, auth, args.not_really),
-            args.admin_url, auth, args.mediapackage_id)
-        retract(args.mediapackage_id, args.mountpoint, args.not_really)
-        delete_workflows(args.mediapackage_id, admin_url, auth, args.not_really)
-        unarchive(args.mediapackage_id, admin_url, auth, args.not_really, args.legacy)
+        delete_mps([args.mediapackage_id], search_url, admin_url, auth, args,
+                   trash=trash, journal=journal)
+
+    if trash:
+        trash.wait()
 
 
 if __name__ == '__main__':
@@ -516,11 +1232,53 @@ if __name__ == '__main__':
         action="store_true",
         help="Use the old archive endpoint '/episode' (up to version 2.0),\ninstead of the new one"
         "'/archive' (from version 2.0, inclusive)")
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=positive_int,
+        default=DEFAULT_JOBS,
+        help='Number of MPs deleted at the same time when the IDs are read from a file.\n'
+        'The steps of each MP are still performed in order. While a MP waits for its\n'
+        'unpublish job to finish, other MPs are processed. (Default: {})'.format(DEFAULT_JOBS))
+    parser.add_argument(
+        '-t',
+        '--trash',
+        action="store_true",
+        help="Move the distribution directories to a '{}' directory in the same filesystem under\n"
+        "the mountpoint, instead of deleting them in place, and delete them from there in the\n"
+        "background, together with any left by a previous run".format(TRASH_DIR))
+    parser.add_argument(
+        '-P',
+        '--purge_jobs',
+        type=positive_int,
+        default=DEFAULT_PURGE_JOBS,
+        help='Number of directories deleted from the trash at the same time (Default: {})'.format(
+            DEFAULT_PURGE_JOBS))
+    parser.add_argument(
+        '-J',
+        '--journal',
+        help='SQLite file where the outcome of every step of every MP is recorded. If the file\n'
+        'exists, the steps it records as completed are skipped, so that an interrupted\n'
+        'batch can be resumed. It is only read, but not updated, with --not_really')
+    parser.add_argument(
+        '-r',
+        '--report',
+        action="store_true",
+        help='Do not delete anything, but summarize the outcome of the steps of the given MPs\n'
+        'recorded in the journal. Requires --journal')
     parser.add_argument(
         '-n',
         '--not_really',
         action="store_true",
         help='Do not delete anything, but show what would be done if this\noption were not provided')
+    parser.add_argument(
+        '-s',
+        '--series',
+        action='append',
+        help='In a dry run with the IDs read from a file, the published and archived MPs are\n'
+        'listed all at once beforehand. Only list those in this series, so that MPs in\n'
+        'other series are reported as not found. Can be repeated')
+    oc_limiter.add_arguments(parser)
     parser.add_argument(
         '-u',
         '--digest_user',
@@ -533,4 +1291,8 @@ if __name__ == '__main__':
     #print(parser.parse_args())
     #exit(0)
 
-    exit(delete_mp(parser.parse_args()))
+    args = parser.parse_args()
+    if args.report and not args.journal:
+        parser.error("--report requires --journal")
+
+    exit(delete_mp(args))
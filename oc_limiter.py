@@ -0,0 +1,223 @@
+# -*- coding:utf-8 -*-
+
+"""
+Adaptive concurrency limiter for the requests that modify or delete contents in an Opencast system.
+
+The limiter follows an AIMD (additive increase, multiplicative decrease) scheme: the number of
+requests allowed to run at the same time grows by one after every window of requests whose 95th
+percentile latency stays under a target, and is halved whenever a request fails, receives a server
+error (HTTP 5xx) or takes much longer than the target.
+"""
+
+import argparse
+import math
+import threading
+import time
+import Queue
+
+
+# Default maximum number of requests in flight at the same time
+DEFAULT_MAX_CONCURRENCY = 16
+
+# Default target for the 95th percentile of the request latency, in seconds
+DEFAULT_TARGET_LATENCY = 2.0
+
+# A single request taking this many times the target latency makes the limiter back off at once
+LATENCY_SPIKE_FACTOR = 3
+
+# Minimum number of latency samples evaluated before growing the concurrency
+MIN_WINDOW_SIZE = 10
+
+# Percentile of the latencies in a window that is compared with the target
+LATENCY_PERCENTILE = 95
+
+# Responses with an HTTP status of at least this value are considered errors
+SERVER_ERROR_STATUS = 500
+
+# Weight of each completed request in the moving average of the limit, which smooths the AIMD
+# sawtooth into the concurrency the limiter settled on
+SETTLED_WEIGHT = 0.05
+
+# Seconds between two checks of the workers' state by the main thread
+POOL_POLL_INTERVAL = 0.1
+
+
+class AdaptiveLimiter(object):
+    """
+    Limit the number of requests in flight, adapting the limit to the latency of the server
+    """
+
+    def __init__(self, maximum=DEFAULT_MAX_CONCURRENCY, target_latency=DEFAULT_TARGET_LATENCY):
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.limit = 1
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        # Latencies of the requests completed since the last change of the limit
+        self.latencies = []
+        # Increased at every back off, so that the requests which were already running at that
+        # moment do not make the limiter back off again
+        self.generation = 0
+        self.peak = 1
+        self.settled = 1.0
+        self.backoffs = 0
+        self.last_latency = None
+
+    def call(self, function, *args, **kwargs):
+        """
+        Call a function performing a request as soon as the limit allows it, and return its result.
+
+        The call fails if the function raises an exception or returns a response with an HTTP
+        status of SERVER_ERROR_STATUS or higher
+        """
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+            generation = self.generation
+
+        start = time.time()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            self.release(generation, time.time() - start, True)
+            raise
+
+        self.release(generation, time.time() - start,
+                     getattr(result, 'status_code', 0) >= SERVER_ERROR_STATUS)
+        return result
+
+    def release(self, generation, latency, failed):
+        """
+        Account for a completed request and adapt the limit
+        """
+        with self.condition:
+            self.in_flight -= 1
+            self.settled += SETTLED_WEIGHT * (self.limit - self.settled)
+            if failed or latency > self.target_latency * LATENCY_SPIKE_FACTOR:
+                if generation == self.generation:
+                    self.back_off()
+            else:
+                self.latencies.append(latency)
+                if len(self.latencies) >= max(MIN_WINDOW_SIZE, self.limit):
+                    self.last_latency = percentile(self.latencies, LATENCY_PERCENTILE)
+                    if self.last_latency <= self.target_latency:
+                        self.limit = min(self.limit + 1, self.maximum)
+                        self.peak = max(self.peak, self.limit)
+                        self.latencies = []
+                    else:
+                        self.back_off()
+            self.condition.notify_all()
+
+    def back_off(self):
+        """
+        Halve the limit. Must be called while holding the condition's lock
+        """
+        self.limit = max(self.limit // 2, 1)
+        self.latencies = []
+        self.generation += 1
+        self.backoffs += 1
+
+    def summary(self):
+        """
+        Describe the concurrency the limiter settled on
+        """
+        if self.last_latency is None:
+            latency = "n/a"
+        else:
+            latency = "{:.2f}s".format(self.last_latency)
+        return ("Settled on about {:.0f} concurrent requests (final: {}, peak: {}, back offs: {}, "
+                "p{} latency: {}, target: {}s)").format(
+                    self.settled, self.limit, self.peak, self.backoffs, LATENCY_PERCENTILE, latency,
+                    self.target_latency)
+
+
+def percentile(values, percent):
+    """
+    Calculate a percentile of a list of values, using the nearest rank method
+    """
+    ordered = sorted(values)
+    return ordered[max(int(math.ceil(percent / 100.0 * len(ordered))) - 1, 0)]
+
+
+def map_limited(limiter, function, items, progress=None):
+    """
+    Call the function with every item as the only argument, as many at a time as the limiter allows,
+    and return the list of results, in the same order as the items.
+
+    If provided, progress is called with the number of completed calls after each of them, one
+    call at a time. If a call raises an exception, no more calls are started and the exception is
+    raised again once the running ones are over
+    """
+    pending = Queue.Queue()
+    for index, item in enumerate(items):
+        pending.put((index, item))
+
+    results = [None] * pending.qsize()
+    lock = threading.Lock()
+    state = {'done': 0, 'error': None}
+
+    def work():
+        while state['error'] is None:
+            try:
+                index, item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = limiter.call(function, item)
+            except Exception as exc:
+                state['error'] = exc
+                return
+            with lock:
+                state['done'] += 1
+                if progress:
+                    progress(state['done'])
+
+    workers = [threading.Thread(target=work) for dummy in range(min(limiter.maximum, len(results)))]
+    for worker in workers:
+        # Do not let the workers keep the script alive after an interruption
+        worker.daemon = True
+        worker.start()
+
+    # Joining without a timeout would block the keyboard interrupts in Python 2
+    while any(worker.is_alive() for worker in workers):
+        time.sleep(POOL_POLL_INTERVAL)
+
+    if state['error'] is not None:
+        raise state['error']
+    return results
+
+
+def positive_int(value):
+    """
+    Parse a strictly positive integer argument
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("'{0}' is not an integer".format(value))
+    if number < 1:
+        raise argparse.ArgumentTypeError("'{0}' is not a positive number".format(value))
+    return number
+
+
+def add_arguments(parser):
+    """
+    Add the options to configure the limiter to an argparse parser
+    """
+    parser.add_argument(
+        '-c', '--max_concurrency', type=positive_int, default=DEFAULT_MAX_CONCURRENCY,
+        help='Maximum number of delete requests sent to the server at the same time. The actual\n'
+        'number adapts to the server\'s latency (Default: {})'.format(DEFAULT_MAX_CONCURRENCY))
+    parser.add_argument(
+        '-L', '--target_latency', type=float, default=DEFAULT_TARGET_LATENCY,
+        help='Latency, in seconds, under which the 95%% of the delete requests should complete.\n'
+        'Above it, fewer requests are sent at the same time (Default: {})'.format(
+            DEFAULT_TARGET_LATENCY))
+
+
+def from_args(args):
+    """
+    Create a limiter configured by the options added with add_arguments
+    """
+    return AdaptiveLimiter(args.max_concurrency, args.target_latency)